@@ -1,21 +1,29 @@
 """
 Телеграм бот для учета финансов
 """
+import asyncio
+import itertools
 import logging
+import time
+from collections import deque
 from datetime import datetime
 from telegram import Update, ReactionTypeEmoji
+from telegram.error import RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
+    PicklePersistence,
     filters,
     ContextTypes
 )
 
 import config
-from google_sheets import GoogleSheetsManager
-from openai_categorizer import TransactionCategorizer
-from prompt_trainer import PromptTrainer
+from parsers import parse_subscription
+
+# GoogleSheetsManager / TransactionCategorizer / PromptTrainer импортируются
+# внутри main() после проверки конфига: они тянут openai, httpx и google-auth,
+# что заметно удлиняет холодный старт и не нужно, если конфиг невалиден
 
 # Настройка логирования
 logging.basicConfig(
@@ -29,67 +37,295 @@ sheets_manager = None
 categorizer = None
 trainer = None
 
+class ReplyLimiter:
+    """
+    Ограничитель исходящих сообщений Telegram
 
-def _parse_subscription(text):
+    Telegram режет ботов на ~30 сообщений/сек глобально и 1 сообщение/сек
+    на чат; серверный бан по 429 всегда дороже, чем подождать самим.
+    Лимитер выдает каждому сообщению слот отправки с учетом обоих лимитов.
     """
-    Парсит информацию о подписке из текста
-    
+
+    def __init__(self, global_rate=28, per_chat_interval=1.0):
+        self._global_interval = 1.0 / global_rate
+        self._per_chat_interval = per_chat_interval
+        self._last_global = 0.0
+        self._last_per_chat = {}
+        self._lock = asyncio.Lock()
+
+    async def wait(self, chat_id):
+        """Ждет слот отправки для указанного чата"""
+        async with self._lock:
+            now = time.monotonic()
+            wait_global = self._last_global + self._global_interval - now
+            wait_chat = self._last_per_chat.get(chat_id, 0.0) + self._per_chat_interval - now
+            delay = max(0.0, wait_global, wait_chat)
+            send_at = now + delay
+            self._last_global = send_at
+            self._last_per_chat[chat_id] = send_at
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+reply_limiter = ReplyLimiter()
+
+
+async def _reply(update, text):
+    """
+    Отправляет ответ через лимитер
+
+    На HTTP 429 один раз ждет retry_after и повторяет отправку.
+    """
+    await reply_limiter.wait(update.effective_chat.id)
+    try:
+        await update.message.reply_text(text)
+    except RetryAfter as e:
+        logger.warning(f"Telegram 429, ждем {e.retry_after}s")
+        await asyncio.sleep(e.retry_after)
+        await update.message.reply_text(text)
+
+
+# Ограничение буфера накопленных сообщений: deque с maxlen не
+# реаллоцируется при росте и не дает буферу разрастись бесконечно.
+# 200 сообщений достаточно между запусками /process, а pickle
+# персистентности не раздувается у пользователей, забывающих про него
+MESSAGE_BUFFER_MAXLEN = 200
+
+
+def _get_message_buffer(context):
+    """
+    Возвращает буфер сообщений пользователя, создавая его при необходимости
+
     Args:
-        text: текст транзакции
-        
+        context: контекст обработчика
+
     Returns:
-        str: "Yes" если подписка без номера, номер если есть, "" если не подписка
-    
-    Логика: ищет цифру сразу после слова "подписка" (с пробелом или без).
-    Если находит - это номер платежа. Если не находит - это простая подписка (Yes).
+        collections.deque: буфер сообщений
     """
-    import re
-    
-    text_lower = text.lower()
-    
-    # Проверяем, есть ли слово "подписка"
-    if 'подписка' not in text_lower:
-        return ''
-    
-    # Ищем "подписка" и смотрим что идет сразу после него
-    # Если идет пробел + однозначная цифра (1-9) - это номер (например "подписка 1")
-    # Если идет только цифра сразу - это номер (например "подписка3")
-    # Если идет многозначное число или число не сразу - это сумма
-    match_immediate = re.search(r'подписка\s+([1-9])\b|подписка([1-9])', text_lower)
-    
-    if match_immediate:
-        # Нашли однозначную цифру сразу после "подписка" - это номер платежа
-        result = match_immediate.group(1) or match_immediate.group(2)
-        return result
-    else:
-        # Не нашли - это простая подписка
-        return 'Yes'
+    messages = context.user_data.get('messages')
+    if messages is None or not isinstance(messages, deque):
+        # Мигрируем старый list-буфер (например из PicklePersistence)
+        messages = deque(messages or [], maxlen=MESSAGE_BUFFER_MAXLEN)
+        context.user_data['messages'] = messages
+    return messages
+
+
+# Дебаунс подтверждений: при быстрой вставке десятков строк не ставим
+# реакцию на каждое сообщение, а только каждое N-е или после паузы
+ACK_EVERY_N_MESSAGES = 10
+ACK_QUIET_SECONDS = 2.0
+
+
+# Параметры записи больших пачек в Google Sheets
+SHEETS_CHUNK_SIZE = 500  # строк на один append-запрос
+SHEETS_MAX_CONCURRENT_WRITES = 8  # параллельных запросов (квота: 300 записей/мин)
+
+
+async def _write_transactions(transactions):
+    """
+    Записывает транзакции в Google Sheets
+
+    Маленькие пачки уходят одним append-запросом. Большие (сотни строк)
+    режутся на чанки по SHEETS_CHUNK_SIZE и пишутся параллельно, чтобы
+    не упираться в лимит размера запроса и перекрывать сетевые задержки.
+
+    Args:
+        transactions: список словарей с данными транзакций
+
+    Returns:
+        bool: True если все чанки записаны успешно
+    """
+    if len(transactions) <= SHEETS_CHUNK_SIZE:
+        # gspread блокирующий - уводим вызов в поток, чтобы не вешать event loop
+        return await asyncio.to_thread(sheets_manager.add_transactions_batch, transactions)
+
+    chunks = [
+        transactions[i:i + SHEETS_CHUNK_SIZE]
+        for i in range(0, len(transactions), SHEETS_CHUNK_SIZE)
+    ]
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(SHEETS_MAX_CONCURRENT_WRITES)
+
+    async def write_chunk(chunk):
+        async with semaphore:
+            return await loop.run_in_executor(None, sheets_manager.add_transactions_batch, chunk)
+
+    results = await asyncio.gather(*[write_chunk(chunk) for chunk in chunks])
+    return all(results)
+
+
+# Конвейер /process: сообщений на один запрос к OpenAI; с этого же
+# размера включается перекрытие парсинга и записи в Sheets.
+# Выровнено с лимитом marshaled-промпта категоризатора
+PARSE_SUB_BATCH = 16
+
+
+def _build_transaction(msg_data, parsed, username):
+    """
+    Собирает словарь транзакции из сообщения и результата парсинга
+
+    Args:
+        msg_data: словарь сообщения ({'text', 'timestamp'})
+        parsed: результат categorizer
+        username: имя пользователя (вычислено один раз на пачку)
+
+    Returns:
+        dict: данные транзакции для записи в таблицу
+    """
+    text = msg_data['text']
+    amount = parsed['amount']
+
+    return {
+        'date': _format_date(msg_data['timestamp']),  # Используем дефисы вместо слэшей
+        'type': parsed['type'],
+        'description': parsed['description'],
+        'category': parsed['category'],
+        'amount': amount,
+        'currency': parsed.get('currency', 'ILS'),
+        'amount_ils': parsed.get('amount_ils', amount),
+        'username': username,
+        'input': text,  # Сохраняем оригинальный текст для обучения
+        'subscription': parse_subscription(text)  # Информация о подписке
+    }
+
+
+async def _parse_and_write_pipelined(messages, username):
+    """
+    Конвейер парсинг -> запись для больших пачек сообщений
+
+    Продюсер категоризирует сообщения под-пачками по PARSE_SUB_BATCH
+    и кладет готовые транзакции в очередь; консюмер пишет их в Sheets.
+    Первая под-пачка уходит в таблицу сразу (низкая задержка), дальше
+    строки буферизуются до SHEETS_CHUNK_SIZE (пропускная способность).
+    Итоговое время ~ max(парсинг, запись) вместо их суммы.
+
+    Args:
+        messages: буфер сообщений
+        username: имя пользователя
+
+    Returns:
+        bool: True если все записи прошли успешно
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=64)
+    total = len(messages)
+
+    async def producer():
+        try:
+            for start in range(0, total, PARSE_SUB_BATCH):
+                chunk = list(itertools.islice(messages, start, start + PARSE_SUB_BATCH))
+                texts = [m['text'] for m in chunk]
+                parsed_list = await loop.run_in_executor(
+                    None, categorizer.parse_transactions_batch, texts
+                )
+                transactions = [
+                    _build_transaction(m, parsed, username)
+                    for m, parsed in zip(chunk, parsed_list)
+                ]
+                await queue.put(transactions)
+        finally:
+            # Сентинел обязан дойти до консюмера и при ошибке парсинга
+            # (например, CacheMiss в режиме replay) - иначе он навсегда
+            # повиснет на queue.get(), а исключение продюсера потеряется.
+            # Саму ошибку доставит await producer_task после консюмера
+            await queue.put(None)
+
+    async def consumer():
+        success = True
+        first_batch = True
+        buffer = []
+
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+
+            buffer.extend(item)
+            if first_batch or len(buffer) >= SHEETS_CHUNK_SIZE:
+                success = await _write_transactions(buffer) and success
+                buffer = []
+                first_batch = False
+
+        if buffer:
+            success = await _write_transactions(buffer) and success
+
+        return success
+
+    producer_task = asyncio.create_task(producer())
+    success = await consumer()
+    await producer_task
+    return success
+
+
+# Кеш отформатированных дат: strftime - дорогой вызов, а уникальных
+# дат в пачке сообщений обычно одна-две
+_date_format_cache = {}
+
+
+def _format_date(dt):
+    """
+    Форматирует дату транзакции (DD-MM-YY) с кешированием по дню
+
+    Args:
+        dt: datetime
+
+    Returns:
+        str: дата в формате DD-MM-YY
+    """
+    day_key = (dt.year, dt.month, dt.day)
+    formatted = _date_format_cache.get(day_key)
+    if formatted is None:
+        formatted = dt.strftime('%d-%m-%y')
+        _date_format_cache[day_key] = formatted
+    return formatted
+
+
+# Кеш строки "сегодня" для мгновенных транзакций: держим минуту,
+# чтобы не создавать datetime на каждое сообщение
+_TODAY_CACHE = [0.0, '']
+
+
+def _today_date_str():
+    """
+    Возвращает сегодняшнюю дату (DD-MM-YY) с кешем на минуту
+
+    Returns:
+        str: дата в формате DD-MM-YY
+    """
+    now = time.time()
+    if now - _TODAY_CACHE[0] > 60:
+        _TODAY_CACHE[0] = now
+        _TODAY_CACHE[1] = _format_date(datetime.now())
+    return _TODAY_CACHE[1]
 
 
 async def train_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда для ручного запуска обучения"""
     if not trainer:
-        await update.message.reply_text("❌ Trainer not initialized.")
+        await _reply(update, "❌ Trainer not initialized.")
         return
     
-    await update.message.reply_text("🔄 Training in progress...")
-    
-    success = trainer.update_categorizer_prompt()
+    await _reply(update, "🔄 Training in progress...")
+
+    # Поход в Sheets - блокирующий I/O, уводим из event loop
+    success = await asyncio.to_thread(trainer.update_categorizer_prompt)
     
     if success:
         stats = trainer.get_stats()
         message = f"✅ Training completed!\n\n"
         message += f"📊 Examples loaded: {stats['training_examples_count']}\n"
         message += f"📅 Last trained: {stats['last_training_date'] or 'Never'}"
-        await update.message.reply_text(message)
+        await _reply(update, message)
     else:
-        await update.message.reply_text("❌ Training failed. Check logs.")
+        await _reply(update, "❌ Training failed. Check logs.")
 
 
 async def training_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает статистику обучения"""
     if not trainer:
-        await update.message.reply_text("❌ Trainer not initialized.")
+        await _reply(update, "❌ Trainer not initialized.")
         return
     
     stats = trainer.get_stats()
@@ -99,7 +335,7 @@ async def training_stats_command(update: Update, context: ContextTypes.DEFAULT_T
     message += f"Last trained: {stats['last_training_date'] or 'Never'}\n"
     message += f"Need retrain: {'Yes' if stats['should_retrain'] else 'No'}"
     
-    await update.message.reply_text(message)
+    await _reply(update, message)
 
 
 def setup_job_queue(app):
@@ -112,16 +348,25 @@ def setup_job_queue(app):
         if trainer:
             logger.info("Running weekly training...")
             if trainer.should_retrain():
-                success = trainer.update_categorizer_prompt()
+                # Поход в Sheets - блокирующий I/O, уводим из event loop
+                success = await asyncio.to_thread(trainer.update_categorizer_prompt)
                 if success:
                     logger.info("Weekly training completed successfully")
                 else:
                     logger.warning("Weekly training failed")
     
+    async def flush_sheets(context):
+        """Периодический сброс буфера одиночных транзакций в Sheets"""
+        if sheets_manager:
+            await asyncio.to_thread(sheets_manager.flush)
+
     # Запускаем задачу каждый понедельник в 9:00
     job_queue = app.job_queue
-    
+
     if job_queue:
+        # Сбрасываем буфер записей каждые 3 секунды
+        job_queue.run_repeating(flush_sheets, interval=3, name="sheets_flush")
+
         # Запускаем каждый понедельник в 9:00
         job_queue.run_daily(
             weekly_training,
@@ -132,11 +377,10 @@ def setup_job_queue(app):
         logger.info("Weekly training scheduled for Mondays at 9:00 AM")
 
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /start"""
-    user = update.effective_user
-    welcome_message = f"""
-Hey {user.first_name}! 👋
+# Константные тексты команд: собираем один раз при импорте,
+# а не при каждом вызове обработчика
+WELCOME_TEMPLATE = """
+Hey {name}! 👋
 I'm your money tracker bot. Just drop me messages like:
 
 "Bought groceries 1500₽"
@@ -151,12 +395,8 @@ I'll parse them instantly and log to Google Sheets. You'll see ✅ when it's don
 /table – Get your Sheets link
 /help – Quick guide
 """
-    await update.message.reply_text(welcome_message)
 
-
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /help"""
-    help_text = """
+HELP_TEXT = """
 👾 How to use me:
 
 Just send me spendings/incomes in plain text.
@@ -177,106 +417,112 @@ Look for the ✅ reaction when it's logged.
 
 That's it. Just text me what you spent. I got you.
 """
-    await update.message.reply_text(help_text)
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /start"""
+    user = update.effective_user
+    await _reply(update, WELCOME_TEMPLATE.format(name=user.first_name))
+
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /help"""
+    await _reply(update, HELP_TEXT)
 
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает статистику накопленных сообщений"""
     user_id = update.effective_user.id
-    
-    if 'messages' not in context.user_data:
-        context.user_data['messages'] = []
-    
-    messages_count = len(context.user_data['messages'])
-    
+
+    messages = _get_message_buffer(context)
+    messages_count = len(messages)
+
     if messages_count == 0:
-        await update.message.reply_text("📭 Nothing saved yet.")
-    else:
-        stats_text = f"📊 Stats:\n"
-        stats_text += f"Saved: {messages_count} messages\n\n"
-        stats_text += "Latest:\n"
-        
-        for i, msg in enumerate(context.user_data['messages'][-5:], 1):
-            stats_text += f"{i}. {msg['text'][:50]}...\n"
-        
-        stats_text += f"\nRun /process to log them."
-    
-    await update.message.reply_text(stats_text)
+        await _reply(update, "📭 Nothing saved yet.")
+        return
+
+    # Собираем текст списком + join вместо конкатенации строк в цикле
+    parts = [
+        "📊 Stats:",
+        f"Saved: {messages_count} messages",
+        "",
+        "Latest:",
+    ]
+
+    # islice по deque вместо [-5:] - без копирования всего буфера
+    last_five = itertools.islice(messages, max(0, messages_count - 5), messages_count)
+    parts.extend(f"{i}. {msg['text'][:50]}..." for i, msg in enumerate(last_five, 1))
+    parts.append("\nRun /process to log them.")
+
+    await _reply(update, "\n".join(parts))
 
 
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Очищает накопленные сообщения"""
-    if 'messages' in context.user_data:
-        count = len(context.user_data['messages'])
-        context.user_data['messages'] = []
-        await update.message.reply_text(f"🧹 Cleared {count} messages.")
+    messages = _get_message_buffer(context)
+    if messages:
+        count = len(messages)
+        messages.clear()
+        await _reply(update, f"🧹 Cleared {count} messages.")
     else:
-        await update.message.reply_text("📭 Nothing to clear.")
+        await _reply(update, "📭 Nothing to clear.")
 
 
 async def table_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отправляет ссылку на Google таблицу"""
     if sheets_manager and sheets_manager.spreadsheet:
         url = sheets_manager.get_spreadsheet_url()
-        await update.message.reply_text(f"📊 Your sheet:\n{url}")
+        await _reply(update, f"📊 Your sheet:\n{url}")
     else:
-        await update.message.reply_text("❌ Couldn't get the link. Try later.")
+        await _reply(update, "❌ Couldn't get the link. Try later.")
 
 
 async def process_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /process - обрабатывает все накопленные сообщения"""
     user = update.effective_user
     
-    if 'messages' not in context.user_data or len(context.user_data['messages']) == 0:
-        await update.message.reply_text("📭 Nothing to process. Send something first.")
+    messages = _get_message_buffer(context)
+    if len(messages) == 0:
+        await _reply(update, "📭 Nothing to process. Send something first.")
         return
-    
-    messages = context.user_data['messages']
-    await update.message.reply_text(f"⚙️ Processing {len(messages)} messages...\nGimme a sec.")
+    await _reply(update, f"⚙️ Processing {len(messages)} messages...\nGimme a sec.")
     
     try:
-        # Обрабатываем каждое сообщение
-        transactions = []
-        
-        for msg_data in messages:
-            text = msg_data['text']
-            timestamp = msg_data['timestamp']
-            
-            # Используем OpenAI для категоризации
-            parsed = categorizer.parse_transaction(text)
-            
-            # Определяем информацию о подписке
-            subscription_info = _parse_subscription(text)
-            
-            # Формируем данные транзакции
-            transaction = {
-                'date': timestamp.strftime('%d-%m-%y'),  # Используем дефисы вместо слэшей
-                'type': parsed['type'],
-                'description': parsed['description'],
-                'category': parsed['category'],
-                'amount': parsed['amount'],
-                'currency': parsed.get('currency', 'ILS'),
-                'amount_ils': parsed.get('amount_ils', parsed['amount']),
-                'username': user.first_name or user.username or 'Unknown',
-                'input': text,  # Сохраняем оригинальный текст для обучения
-                'subscription': subscription_info  # Информация о подписке
-            }
-            
-            transactions.append(transaction)
-        
-        # Добавляем в Google Sheets
-        if sheets_manager.add_transactions_batch(transactions):
+        # Имя пользователя - инвариант всей пачки
+        username = user.first_name or user.username or 'Unknown'
+        count = len(messages)
+
+        if count > PARSE_SUB_BATCH:
+            # Большая пачка: перекрываем категоризацию и запись в Sheets
+            success = await _parse_and_write_pipelined(messages, username)
+        else:
+            # Категоризируем все сообщения одним запросом к OpenAI
+            # вместо отдельного вызова на каждое сообщение.
+            # Клиент OpenAI блокирующий - уводим в поток
+            parsed_list = await asyncio.to_thread(
+                categorizer.parse_transactions_batch, [m['text'] for m in messages]
+            )
+
+            transactions = [
+                _build_transaction(msg_data, parsed, username)
+                for msg_data, parsed in zip(messages, parsed_list)
+            ]
+
+            # Добавляем в Google Sheets
+            success = await _write_transactions(transactions)
+
+        if success:
             # Очищаем буфер сообщений
-            context.user_data['messages'] = []
-            
-            success_message = f"✅ Logged {len(transactions)} transactions!\n\n/table – See the sheet"
-            await update.message.reply_text(success_message)
+            messages.clear()
+
+            success_message = f"✅ Logged {count} transactions!\n\n/table – See the sheet"
+            await _reply(update, success_message)
         else:
-            await update.message.reply_text("❌ Couldn't add to the sheet. Try again later.")
+            await _reply(update, "❌ Couldn't add to the sheet. Try again later.")
     
     except Exception as e:
         logger.error(f"Ошибка при обработке сообщений: {e}")
-        await update.message.reply_text(f"❌ Something went wrong: {str(e)}")
+        await _reply(update, f"❌ Something went wrong: {str(e)}")
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -285,15 +531,17 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     
     try:
-        # Сразу обрабатываем через OpenAI
-        parsed = categorizer.parse_transaction(text)
+        # Сразу обрабатываем через OpenAI.
+        # Вызов блокирующий (HTTP) - уводим в поток, иначе один пользователь
+        # вешает event loop и сериализует всех остальных
+        parsed = await asyncio.to_thread(categorizer.parse_transaction, text)
         
         # Определяем информацию о подписке
-        subscription_info = _parse_subscription(text)
+        subscription_info = parse_subscription(text)
         
         # Формируем данные транзакции
         transaction = {
-            'date': datetime.now().strftime('%d-%m-%y'),
+            'date': _today_date_str(),
             'type': parsed['type'],
             'description': parsed['description'],
             'category': parsed['category'],
@@ -305,25 +553,43 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'subscription': subscription_info  # Информация о подписке
         }
         
-        # Логируем для отладки
-        logger.info(f"[DEBUG] Transaction data: {transaction}")
-        logger.info(f"[DEBUG] Input text: '{text}'")
-        logger.info(f"[DEBUG] Subscription info: '{subscription_info}'")
+        # Логируем для отладки: %s-формат вычисляется лениво,
+        # только если уровень DEBUG действительно включен
+        logger.debug("Transaction data: %s", transaction)
+        logger.debug("Input text: '%s'", text)
+        logger.debug("Subscription info: '%s'", subscription_info)
         
-        # Сразу добавляем в Google Sheets
+        # Добавляем в Google Sheets: add_transaction только кладет строку
+        # в буфер (микросекунды), сетевая запись уходит фоновым потоком
+        # или по таймеру - обработчик не ждет round-trip к API
         if sheets_manager.add_transaction(transaction):
-            # Молчаливое подтверждение - просто ставим реакцию
-            try:
-                await update.message.set_reaction(reaction=ReactionTypeEmoji(emoji="👍"))
-            except Exception as reaction_error:
-                # Игнорируем ошибки реакции, главное что транзакция записана
-                logger.debug(f"Не удалось поставить реакцию: {reaction_error}")
+            # Дебаунсим подтверждение: при бурной вставке реагируем не на
+            # каждое сообщение, а каждое N-е или после паузы - меньше
+            # исходящих вызовов к Telegram на массовом вводе
+            count = context.user_data.get('ack_msg_count', 0) + 1
+            context.user_data['ack_msg_count'] = count
+
+            now = time.monotonic()
+            last_ack_count = context.user_data.get('last_ack_count', 0)
+            last_ack_time = context.user_data.get('last_ack_time', 0.0)
+
+            if (count - last_ack_count >= ACK_EVERY_N_MESSAGES
+                    or now - last_ack_time > ACK_QUIET_SECONDS):
+                context.user_data['last_ack_count'] = count
+                context.user_data['last_ack_time'] = now
+
+                # Молчаливое подтверждение - просто ставим реакцию
+                try:
+                    await update.message.set_reaction(reaction=ReactionTypeEmoji(emoji="👍"))
+                except Exception as reaction_error:
+                    # Игнорируем ошибки реакции, главное что транзакция записана
+                    logger.debug(f"Не удалось поставить реакцию: {reaction_error}")
         else:
-            await update.message.reply_text("❌ Error logging. Try again.")
+            await _reply(update, "❌ Error logging. Try again.")
     
     except Exception as e:
         logger.error(f"Ошибка при обработке сообщения: {e}")
-        await update.message.reply_text(f"❌ Error: {str(e)}")
+        await _reply(update, f"❌ Error: {str(e)}")
 
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -342,15 +608,31 @@ def main():
         for error in config_errors:
             logger.error(f"  - {error}")
         return
-    
+
+    # uvloop ускоряет event loop в ~2 раза на socket-нагрузке
+    # (long-poll Telegram + HTTPS к OpenAI и Sheets); не критичен,
+    # поэтому при его отсутствии просто работаем на стандартном цикле
+    try:
+        import uvloop
+        uvloop.install()
+        logger.info("uvloop включен")
+    except ImportError:
+        logger.info("uvloop не установлен, используем стандартный event loop")
+
+    # Тяжелые зависимости импортируем только после успешной валидации
+    from google_sheets import get_sheets_manager
+    from openai_categorizer import TransactionCategorizer
+    from prompt_trainer import PromptTrainer
+
+
     # Инициализация Google Sheets
     logger.info("Подключение к Google Sheets...")
-    sheets_manager = GoogleSheetsManager(
+    sheets_manager = get_sheets_manager(
         config.GOOGLE_CREDENTIALS_FILE,
         config.SPREADSHEET_NAME
     )
-    
-    if not sheets_manager.connect():
+
+    if not sheets_manager:
         logger.error("Не удалось подключиться к Google Sheets")
         return
     
@@ -372,21 +654,35 @@ def main():
     logger.info("✅ Prompt Trainer готов")
     
     # Создание приложения
-    application = Application.builder().token(config.TELEGRAM_BOT_TOKEN).build()
-    
+    # PicklePersistence сохраняет user_data на диск: накопленные сообщения
+    # переживают рестарт и не требуют повторных вызовов OpenAI
+    persistence = PicklePersistence(filepath="bot_state.pkl")
+    # concurrent_updates: по умолчанию PTB обрабатывает апдейты строго
+    # по одному - пока один пользователь ждет OpenAI, остальные стоят
+    # в очереди. С concurrent_updates + block=False обработчики крутятся
+    # параллельно; общее состояние (sheets, categorizer) защищено их
+    # собственными локами
+    application = (
+        Application.builder()
+        .token(config.TELEGRAM_BOT_TOKEN)
+        .persistence(persistence)
+        .concurrent_updates(True)
+        .build()
+    )
+
     # Регистрация обработчиков
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("table", table_command))
-    application.add_handler(CommandHandler("train", train_command))
-    application.add_handler(CommandHandler("training_stats", training_stats_command))
+    application.add_handler(CommandHandler("start", start, block=False))
+    application.add_handler(CommandHandler("help", help_command, block=False))
+    application.add_handler(CommandHandler("table", table_command, block=False))
+    application.add_handler(CommandHandler("train", train_command, block=False))
+    application.add_handler(CommandHandler("training_stats", training_stats_command, block=False))
     # Оставляем старые команды для обратной совместимости
-    application.add_handler(CommandHandler("process", process_command))
-    application.add_handler(CommandHandler("clear", clear_command))
-    application.add_handler(CommandHandler("stats", stats_command))
-    
+    application.add_handler(CommandHandler("process", process_command, block=False))
+    application.add_handler(CommandHandler("clear", clear_command, block=False))
+    application.add_handler(CommandHandler("stats", stats_command, block=False))
+
     # Обработчик текстовых сообщений
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message, block=False))
     
     # Обработчик ошибок
     application.add_error_handler(error_handler)
@@ -395,8 +691,20 @@ def main():
     setup_job_queue(application)
     
     # Запуск бота
+    # Подписываемся только на "message" - остальные типы апдейтов
+    # (каналы, редактирования, колбэки) бот все равно не обрабатывает
     logger.info("🚀 Бот запущен!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if config.WEBHOOK_URL:
+        # Webhook для продакшена: без цикла long-poll
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=config.PORT,
+            url_path=config.TELEGRAM_BOT_TOKEN,
+            webhook_url=f"{config.WEBHOOK_URL}/{config.TELEGRAM_BOT_TOKEN}",
+            allowed_updates=["message"]
+        )
+    else:
+        application.run_polling(allowed_updates=["message"])
 
 
 if __name__ == '__main__':
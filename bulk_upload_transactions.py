@@ -2,11 +2,36 @@
 Скрипт для массовой загрузки исторических транзакций в Google Sheets
 """
 import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from google_sheets import GoogleSheetsManager
+from google_sheets import get_sheets_manager
 from openai_categorizer import TransactionCategorizer
+from parsers import parse_subscription
 import config
 
+# Паттерны исторических строк компилируем один раз при импорте
+_DATE_RE = re.compile(r'(\d+)\s+октября')
+_DATE_STRIP_RE = re.compile(r'^\d+\s+октября\s+')
+# \$ вместо $ - голый $ в альтернации матчит конец строки, а не знак доллара
+_AMOUNT_RE = re.compile(r'(\d+(?:\.\d+)?)\s*(доллары?|рублей?|₽|\$|USD|RUB)?\s*$')
+_AMOUNT_STRIP_RE = re.compile(r'\s+\d+(?:\.\d+)?\s*(доллары?|рублей?|₽|\$|USD|RUB)?\s*$')
+
+# Словарь валютных маркеров вместо цепочки substring-проверок;
+# ключи соответствуют вариантам, которые ловит _AMOUNT_RE
+_CURRENCY_TAGS = {
+    'доллар': 'USD',
+    'usd': 'USD',
+    '$': 'USD',
+    'рубл': 'RUB',
+    'rub': 'RUB',
+    '₽': 'RUB',
+}
+
+# Курсы валют строим один раз при импорте, а не на каждый вызов
+_EXCHANGE_RATES = {'ILS': 1.0, 'USD': 3.7, 'EUR': 4.0, 'RUB': 0.04, 'GBP': 4.7}
+
+
 def parse_historical_transaction(text):
     """
     Парсит историческую транзакцию из текста
@@ -21,41 +46,39 @@ def parse_historical_transaction(text):
     text = text.strip()
     
     # Ищем дату в начале
-    date_match = re.match(r'(\d+)\s+октября', text)
+    date_match = _DATE_RE.match(text)
     if not date_match:
         return None
-    
+
     day = date_match.group(1)
     date_str = f"{day}-10-25"  # 2025 год
-    
+
     # Убираем дату из текста
-    remaining_text = re.sub(r'^\d+\s+октября\s+', '', text)
-    
+    remaining_text = _DATE_STRIP_RE.sub('', text)
+
     # Ищем сумму в конце
-    amount_match = re.search(r'(\d+(?:\.\d+)?)\s*(доллары?|рублей?|₽|$|USD|RUB)?\s*$', remaining_text)
+    amount_match = _AMOUNT_RE.search(remaining_text)
     if not amount_match:
         return None
     
     amount = float(amount_match.group(1))
     currency_hint = amount_match.group(2) if amount_match.group(2) else ''
     
-    # Определяем валюту
+    # Определяем валюту: .lower() один раз + поиск по словарю маркеров
     currency = 'ILS'  # по умолчанию
-    if 'доллар' in currency_hint.lower() or 'usd' in currency_hint.lower():
-        currency = 'USD'
-    elif 'рубл' in currency_hint.lower() or '₽' in currency_hint or 'rub' in currency_hint.lower():
-        currency = 'RUB'
+    if currency_hint:
+        hint_lower = currency_hint.lower()
+        currency = next(
+            (code for tag, code in _CURRENCY_TAGS.items() if tag in hint_lower),
+            'ILS'
+        )
     
     # Убираем сумму из текста для описания
-    description_text = re.sub(r'\s+\d+(?:\.\d+)?\s*(доллары?|рублей?|₽|USD|RUB)?\s*$', '', remaining_text)
+    description_text = _AMOUNT_STRIP_RE.sub('', remaining_text)
     
     # Определяем тип транзакции
     transaction_type = 'Expense'  # по умолчанию расход
-    
-    # Конвертируем в ILS
-    exchange_rates = {'ILS': 1.0, 'USD': 3.7, 'EUR': 4.0, 'RUB': 0.04, 'GBP': 4.7}
-    amount_ils = round(amount * exchange_rates.get(currency, 1.0), 2)
-    
+
     return {
         'date': date_str,
         'type': transaction_type,
@@ -63,51 +86,56 @@ def parse_historical_transaction(text):
         'category': 'Other',  # будет определено через GPT
         'amount': amount,
         'currency': currency,
-        'amount_ils': amount_ils,
+        'amount_ils': amount,  # пересчитывается пачкой в _convert_amounts_to_ils
         'username': 'Liuba',
         'input': text,
-        'subscription': _parse_subscription(text)
+        'subscription': parse_subscription(text)
     }
 
-def _parse_subscription(text):
+
+def _convert_amounts_to_ils(transactions):
     """
-    Парсит информацию о подписке из текста
-    
-    Логика: ищет цифру сразу после слова "подписка" (с пробелом или без).
-    Если находит - это номер платежа. Если не находит - это простая подписка (Yes).
+    Пересчитывает amount_ils для всех транзакций одним проходом
+
+    Арифметика вынесена из парсера в отдельный батч-проход: курсы и
+    round привязываются к локальным именам один раз, внутри цикла
+    остаются только лукап и умножение.
     """
-    import re
-    text_lower = text.lower()
-    
-    if 'подписка' not in text_lower:
-        return ''
-    
-    # Ищем "подписка" и смотрим что идет сразу после него
-    # Если идет пробел + однозначная цифра (1-9) - это номер (например "подписка 1")
-    # Если идет только цифра сразу - это номер (например "подписка3")
-    # Если идет многозначное число или число не сразу - это сумма
-    match_immediate = re.search(r'подписка\s+([1-9])\b|подписка([1-9])', text_lower)
-    
-    if match_immediate:
-        # Нашли однозначную цифру сразу после "подписка" - это номер платежа
-        result = match_immediate.group(1) or match_immediate.group(2)
-        return result
-    else:
-        # Не нашли - это простая подписка
-        return 'Yes'
+    get_rate = _EXCHANGE_RATES.get
+    _round = round
+    for transaction in transactions:
+        transaction['amount_ils'] = _round(
+            transaction['amount'] * get_rate(transaction['currency'], 1.0), 2
+        )
 
 def categorize_transactions(transactions, categorizer):
     """
     Категоризирует транзакции через GPT
+
+    Вызовы OpenAI - чистый I/O, поэтому гоняем их параллельно в пуле
+    потоков: N транзакций обрабатываются за ~время одной вместо N подряд.
+    Частоту запросов сглаживает общий rate limiter категоризатора.
     """
-    for transaction in transactions:
+    # Статусы копим в списке и печатаем одним write: print на каждую
+    # строку - это лок stdout + write + flush, на больших импортах
+    # синхронизация I/O начинает доминировать (list.append потокобезопасен)
+    status_lines = []
+
+    def categorize_one(transaction):
         try:
             parsed = categorizer.parse_transaction(transaction['input'])
             transaction['category'] = parsed['category']
             transaction['description'] = parsed['description']
-            print(f"✅ {transaction['input']} → {transaction['category']}")
+            status_lines.append(f"✅ {transaction['input']} → {transaction['category']}")
         except Exception as e:
-            print(f"❌ Error categorizing {transaction['input']}: {e}")
+            status_lines.append(f"❌ Error categorizing {transaction['input']}: {e}")
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        # list() дожидается завершения всех задач
+        list(executor.map(categorize_one, transactions))
+
+    if status_lines:
+        sys.stdout.write('\n'.join(status_lines) + '\n')
 
 def main():
     """Основная функция"""
@@ -134,16 +162,22 @@ def main():
     
     print("🔄 Parsing transactions...")
     
-    # Парсим транзакции
+    # Парсим транзакции; статусы буферизуем и пишем одним вызовом
     transactions = []
+    parse_lines = []
     for text in transactions_text:
         transaction = parse_historical_transaction(text)
         if transaction:
             transactions.append(transaction)
-            print(f"📝 Parsed: {text}")
+            parse_lines.append(f"📝 Parsed: {text}")
         else:
-            print(f"❌ Failed to parse: {text}")
-    
+            parse_lines.append(f"❌ Failed to parse: {text}")
+
+    sys.stdout.write('\n'.join(parse_lines) + '\n')
+
+    # Числовая конвертация - одним проходом по всем строкам
+    _convert_amounts_to_ils(transactions)
+
     print(f"\n✅ Parsed {len(transactions)} transactions")
     
     # Инициализируем категоризатор
@@ -156,12 +190,12 @@ def main():
     
     # Подключаемся к Google Sheets
     print("\n📊 Connecting to Google Sheets...")
-    sheets_manager = GoogleSheetsManager(
+    sheets_manager = get_sheets_manager(
         config.GOOGLE_CREDENTIALS_FILE,
         config.SPREADSHEET_NAME
     )
-    
-    if not sheets_manager.connect():
+
+    if not sheets_manager:
         print("❌ Failed to connect to Google Sheets")
         return
     
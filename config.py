@@ -17,6 +17,25 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 GOOGLE_CREDENTIALS_FILE = os.getenv('GOOGLE_CREDENTIALS_FILE', 'my-finance-475615-72e35dbf9d52.json')
 SPREADSHEET_NAME = os.getenv('SPREADSHEET_NAME', 'Финансы')
 
+# Режим кеша ответов OpenAI:
+#   enabled  - читаем и пишем кеш (по умолчанию)
+#   replay   - только читаем; промах = ошибка CacheMiss (для отладки
+#              пост-обработки без трат на API)
+#   disabled - кеш выключен полностью
+CACHE_MODE = os.getenv('CACHE_MODE', 'enabled')
+
+# TTL кеша обучающих примеров из Google Sheets (секунды): пока кеш
+# свеж, построение промпта не делает запрос к Sheets API
+TRAINING_CACHE_TTL = int(os.getenv('TRAINING_CACHE_TTL', '600'))
+
+# Сколько примеров попадает в промпт категоризатора: каждый пример -
+# это токены в каждом запросе к OpenAI, меньше = быстрее и дешевле
+TRAINING_EXAMPLES_LIMIT = int(os.getenv('TRAINING_EXAMPLES_LIMIT', '8'))
+
+# Webhook (для продакшена; если WEBHOOK_URL пустой - работаем через polling)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+PORT = int(os.getenv('PORT', '8443'))
+
 # Проверка наличия необходимых переменных
 def validate_config():
     """Проверяет наличие всех необходимых настроек"""
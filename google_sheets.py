@@ -2,10 +2,52 @@
 Модуль для работы с Google Sheets API
 """
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from google.oauth2.service_account import Credentials
 from datetime import datetime
+import logging
 import os
 import json
+import threading
+
+from rate_limiter import sheets_bucket
+
+logger = logging.getLogger(__name__)
+
+# Файл с закешированными id таблиц: open_by_key - прямой запрос к Sheets
+# API, open по имени - поиск по Drive (~400мс дороже)
+_SPREADSHEET_IDS_FILE = 'spreadsheet_ids.json'
+
+# Синглтон менеджеров: бот и bulk-скрипт на одной машине не должны
+# дважды платить за OAuth-хендшейк и открытие таблицы
+_managers = {}
+
+# Кеш объектов Credentials: разбор ключа сервис-аккаунта (JSON + RSA)
+# не бесплатен, а reconnect-ы после ошибок дергают connect() повторно
+_creds_cache = {}
+
+
+def get_sheets_manager(credentials_file, spreadsheet_name):
+    """
+    Возвращает общий подключенный GoogleSheetsManager
+
+    Args:
+        credentials_file: путь к JSON файлу с credentials
+        spreadsheet_name: название таблицы
+
+    Returns:
+        GoogleSheetsManager или None, если подключение не удалось
+    """
+    key = (credentials_file, spreadsheet_name)
+    manager = _managers.get(key)
+    if manager is not None:
+        return manager
+
+    manager = GoogleSheetsManager(credentials_file, spreadsheet_name)
+    if not manager.connect():
+        return None
+
+    _managers[key] = manager
+    return manager
 
 
 class GoogleSheetsManager:
@@ -22,39 +64,96 @@ class GoogleSheetsManager:
         self.client = None
         self.spreadsheet = None
         self.worksheet = None
+        self.spreadsheet_id = None
+        self._url = None
+
+        # Микро-батчинг одиночных транзакций: append_row - это полный
+        # round-trip к API на каждое сообщение, поэтому строки копятся
+        # в буфере и сбрасываются пачкой (по размеру или по таймеру)
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
+        self.buffer_flush_size = 20
+        # Крайний срок отправки: одиночное сообщение не должно ждать
+        # периодического flush из бота - взводим таймер на полсекунды
+        # при первой строке в буфере
+        self.buffer_max_wait = 0.5
+        self._flush_timer = None
         
     def connect(self):
         """Подключение к Google Sheets"""
         try:
             scope = [
-                'https://spreadsheets.google.com/feeds',
+                'https://www.googleapis.com/auth/spreadsheets',
                 'https://www.googleapis.com/auth/drive'
             ]
-            
+
             # Проверяем, есть ли JSON в переменной окружения (для Railway)
             google_creds_json = os.getenv('GOOGLE_CREDENTIALS_JSON')
-            
-            if google_creds_json:
-                # Используем credentials из переменной окружения
-                creds_dict = json.loads(google_creds_json)
-                credentials = ServiceAccountCredentials.from_json_keyfile_dict(
-                    creds_dict, scope
-                )
-            else:
-                # Используем файл (для локальной разработки)
-                credentials = ServiceAccountCredentials.from_json_keyfile_name(
-                    self.credentials_file, scope
-                )
+
+            # Повторный connect() (reconnect после ошибки) не должен заново
+            # парсить JSON и поднимать RSA-ключ
+            creds_key = ('env', hash(google_creds_json)) if google_creds_json \
+                else ('file', self.credentials_file)
+            credentials = _creds_cache.get(creds_key)
+
+            if credentials is None:
+                if google_creds_json:
+                    # Используем credentials из переменной окружения
+                    creds_dict = json.loads(google_creds_json)
+                    credentials = Credentials.from_service_account_info(
+                        creds_dict, scopes=scope
+                    )
+                else:
+                    # Используем файл (для локальной разработки)
+                    credentials = Credentials.from_service_account_file(
+                        self.credentials_file, scopes=scope
+                    )
+                _creds_cache[creds_key] = credentials
             
             self.client = gspread.authorize(credentials)
-            
-            # Открываем или создаем таблицу
+
+            # gspread держит одну авторизованную requests-сессию на весь
+            # срок жизни клиента (keep-alive вместо TCP+TLS на каждый
+            # вызов). Расширяем пул соединений под параллельные записи
+            # чанков из бота, чтобы они не вставали в очередь за сокетом
             try:
-                self.spreadsheet = self.client.open(self.spreadsheet_name)
-            except gspread.SpreadsheetNotFound:
-                self.spreadsheet = self.client.create(self.spreadsheet_name)
-                # Делаем таблицу доступной для редактирования
-                self.spreadsheet.share('', perm_type='anyone', role='writer')
+                from requests.adapters import HTTPAdapter, Retry
+                # В gspread 5.x авторизованная сессия лежит прямо на
+                # клиенте (client.http_client - это уже 6.x)
+                session = self.client.session
+                adapter = HTTPAdapter(
+                    pool_connections=4,
+                    pool_maxsize=16,
+                    # Транспортные сбои (DNS, reset, 5xx) ретраим на уровне
+                    # сессии с паузой, не роняя всю запись
+                    max_retries=Retry(total=3, backoff_factor=0.5,
+                                      status_forcelist=(500, 502, 503, 504))
+                )
+                session.mount('https://', adapter)
+            except Exception as e:
+                print(f"[WARNING] Could not tune HTTP connection pool: {e}")
+
+            # Открываем таблицу: сначала по id (прямой запрос) - из
+            # переменной окружения или локального кеша, - только потом
+            # по имени (поиск по Drive)
+            cached_id = os.getenv('SPREADSHEET_ID') or self._load_cached_spreadsheet_id()
+            if cached_id:
+                try:
+                    self.spreadsheet = self.client.open_by_key(cached_id)
+                except Exception as e:
+                    print(f"[WARNING] Could not open spreadsheet by cached id: {e}")
+                    self.spreadsheet = None
+
+            if not self.spreadsheet:
+                # Открываем или создаем таблицу
+                try:
+                    self.spreadsheet = self.client.open(self.spreadsheet_name)
+                except gspread.SpreadsheetNotFound:
+                    self.spreadsheet = self.client.create(self.spreadsheet_name)
+                    # Делаем таблицу доступной для редактирования
+                    self.spreadsheet.share('', perm_type='anyone', role='writer')
+
+                self._save_cached_spreadsheet_id(self.spreadsheet.id)
             
             # Открываем или создаем первый лист
             try:
@@ -64,16 +163,59 @@ class GoogleSheetsManager:
             
             # Проверяем и создаем заголовки если их нет
             self._ensure_headers()
-            
+
+            # Запоминаем id и URL один раз при подключении
+            self.spreadsheet_id = self.spreadsheet.id
+            self._url = self.spreadsheet.url
+
             return True
             
         except Exception as e:
             print(f"Ошибка подключения к Google Sheets: {e}")
             return False
     
+    def _load_cached_spreadsheet_id(self):
+        """Возвращает закешированный id таблицы или None"""
+        try:
+            if not os.path.exists(_SPREADSHEET_IDS_FILE):
+                return None
+            with open(_SPREADSHEET_IDS_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f).get(self.spreadsheet_name)
+        except Exception as e:
+            print(f"[WARNING] Could not read spreadsheet id cache: {e}")
+            return None
+
+    def _save_cached_spreadsheet_id(self, spreadsheet_id):
+        """Сохраняет id таблицы для последующих open_by_key"""
+        try:
+            ids = {}
+            if os.path.exists(_SPREADSHEET_IDS_FILE):
+                with open(_SPREADSHEET_IDS_FILE, 'r', encoding='utf-8') as f:
+                    ids = json.load(f)
+            ids[self.spreadsheet_name] = spreadsheet_id
+            with open(_SPREADSHEET_IDS_FILE, 'w', encoding='utf-8') as f:
+                json.dump(ids, f, indent=2, ensure_ascii=False)
+        except Exception as e:
+            print(f"[WARNING] Could not save spreadsheet id cache: {e}")
+
+    # Версия схемы заголовков: при изменении набора колонок достаточно
+    # поднять версию, и старые сентинелы перестанут подавлять проверку
+    _HEADERS_VERSION = 'v1'
+
+    def _headers_sentinel_path(self):
+        """Путь локального файла-сентинела проверки заголовков"""
+        return f'.headers_ok_{self._HEADERS_VERSION}_{self.spreadsheet.id}'
+
     def _ensure_headers(self):
-        """Создает заголовки в таблице, если их нет"""
+        """Создает заголовки в таблице, если их нет
+
+        Проверка row_values(1) - сетевой RPC (~300мс); после первой
+        успешной проверки пишем локальный сентинел и дальше пропускаем.
+        """
         try:
+            if os.path.exists(self._headers_sentinel_path()):
+                return
+
             first_row = self.worksheet.row_values(1)
             
             # Если таблица пустая - создаем все заголовки
@@ -98,20 +240,86 @@ class GoogleSheetsManager:
                     'backgroundColor': {'red': 0.9, 'green': 0.9, 'blue': 0.9}
                 })
                 print("[INFO] Headers created with 'input' column")
-            
+                self._write_headers_sentinel()
+
             # Проверяем, есть ли колонка 'input'
             elif len(first_row) < 9 or first_row[8] != 'input':
                 print(f"[WARNING] Table has {len(first_row)} columns, expected 9")
                 print(f"[WARNING] Current headers: {first_row}")
                 print("[INFO] Please add 'input' column manually or recreate the table")
-                
+            else:
+                self._write_headers_sentinel()
+
         except Exception as e:
             print(f"Ошибка при создании заголовков: {e}")
+
+    def _write_headers_sentinel(self):
+        """Отмечает локально, что заголовки таблицы уже проверены"""
+        try:
+            with open(self._headers_sentinel_path(), 'w') as f:
+                f.write(datetime.now().isoformat())
+        except Exception as e:
+            print(f"[WARNING] Could not write headers sentinel: {e}")
     
+    # Порядок колонок таблицы после даты (дата форматируется отдельно -
+    # ей нужен str()). Кортеж ключей + get в цикле быстрее одиннадцати
+    # атрибутных обращений на каждую строку в bulk-загрузках
+    _ROW_KEYS = (
+        'type',
+        'description',
+        'category',
+        'amount',
+        'currency',
+        'amount_ils',
+        'username',
+        'input',
+        'subscription',
+        'corrected'
+    )
+
+    def _transaction_to_row(self, transaction_data):
+        """
+        Преобразует словарь транзакции в строку таблицы
+
+        Args:
+            transaction_data: словарь с данными транзакции
+
+        Returns:
+            list: значения ячеек в порядке колонок таблицы
+        """
+        # Форматируем данные для корректного отображения в Google Sheets
+        get = transaction_data.get
+        row = [str(get('date', ''))]  # Дата как текст
+        row.extend(get(key, '') for key in self._ROW_KEYS)
+        return row
+
+    def append_rows(self, rows):
+        """
+        Добавляет готовые строки в таблицу одним API-запросом
+
+        Args:
+            rows: 2D список значений ячеек
+        """
+        try:
+            if not rows:
+                return False
+
+            # Ждем бюджет на запись, чтобы не упереться в квоту Sheets
+            sheets_bucket.acquire()
+
+            # Один values.append на весь список вместо запроса на каждую строку
+            # Используем value_input_option='RAW' чтобы данные записывались как есть, без интерпретации
+            self.worksheet.append_rows(rows, value_input_option='RAW')
+            return True
+
+        except Exception as e:
+            print(f"Ошибка при добавлении строк: {e}")
+            return False
+
     def add_transaction(self, transaction_data):
         """
         Добавляет транзакцию в таблицу
-        
+
         Args:
             transaction_data: словарь с данными транзакции
                 - date: дата (DD/MM/YY)
@@ -124,73 +332,79 @@ class GoogleSheetsManager:
                 - username: имя пользователя
         """
         try:
-            # Форматируем данные для корректного отображения в Google Sheets
-            row = [
-                str(transaction_data.get('date', '')),  # Дата как текст
-                transaction_data.get('type', ''),
-                transaction_data.get('description', ''),
-                transaction_data.get('category', ''),
-                transaction_data.get('amount', ''),  # Число
-                transaction_data.get('currency', ''),  # Валюта
-                transaction_data.get('amount_ils', ''),  # Число
-                transaction_data.get('username', ''),
-                transaction_data.get('input', ''),  # Оригинальный текст
-                transaction_data.get('subscription', ''),  # Информация о подписке
-                transaction_data.get('corrected', '')  # Отметка об исправлении
-            ]
-            
+            row = self._transaction_to_row(transaction_data)
+
             # Логируем для отладки
-            print(f"[DEBUG] Adding row: {row}")
-            print(f"[DEBUG] Input value: '{transaction_data.get('input', 'EMPTY')}'")
-            
-            # Используем value_input_option='RAW' чтобы данные записывались как есть, без интерпретации
-            self.worksheet.append_row(row, value_input_option='RAW')
+            # Лениво: аргументы форматируются только при включенном DEBUG
+            logger.debug("Adding row: %s", row)
+            logger.debug("Input value: '%s'", transaction_data.get('input', 'EMPTY'))
+
+            # Кладем строку в буфер; реальная запись уйдет пачкой
+            with self._buffer_lock:
+                self._buffer.append(row)
+                should_flush = len(self._buffer) >= self.buffer_flush_size
+                if not should_flush and self._flush_timer is None:
+                    # Первая строка в буфере - гарантируем отправку
+                    # не позже buffer_max_wait даже без новых сообщений
+                    self._flush_timer = threading.Timer(self.buffer_max_wait, self.flush)
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+
+            if should_flush:
+                # Сам round-trip к API уводим в фоновый поток: вызывающий
+                # (обработчик бота) не должен ждать сеть - при сбое flush
+                # вернет строки в буфер и их заберет следующая попытка
+                threading.Thread(target=self.flush, daemon=True).start()
+
             return True
-            
+
         except Exception as e:
             print(f"Ошибка при добавлении транзакции: {e}")
             return False
-    
+
+    def flush(self):
+        """
+        Сбрасывает накопленные строки в таблицу одним append-запросом
+
+        Вызывается при заполнении буфера и периодически по таймеру из бота.
+
+        Returns:
+            bool: True если буфер пуст или записан успешно
+        """
+        with self._buffer_lock:
+            rows = self._buffer
+            self._buffer = []
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+        if not rows:
+            return True
+
+        if self.append_rows(rows):
+            return True
+
+        # Не получилось - возвращаем строки в буфер до следующего flush
+        with self._buffer_lock:
+            self._buffer = rows + self._buffer
+        return False
+
     def add_transactions_batch(self, transactions):
         """
-        Добавляет несколько транзакций за раз
-        
+        Добавляет несколько транзакций за раз одним запросом
+
         Args:
             transactions: список словарей с данными транзакций
         """
         try:
-            rows = []
-            for transaction in transactions:
-                # Форматируем данные для корректного отображения в Google Sheets
-                row = [
-                    str(transaction.get('date', '')),  # Дата как текст
-                    transaction.get('type', ''),
-                    transaction.get('description', ''),
-                    transaction.get('category', ''),
-                    transaction.get('amount', ''),  # Число
-                    transaction.get('currency', ''),  # Валюта
-                    transaction.get('amount_ils', ''),  # Число
-                    transaction.get('username', ''),
-                    transaction.get('input', ''),  # Оригинальный текст
-                    transaction.get('subscription', ''),  # Информация о подписке
-                    transaction.get('corrected', '')  # Отметка об исправлении
-                ]
-                rows.append(row)
-            
-            if rows:
-                # Используем value_input_option='RAW' чтобы данные записывались как есть, без интерпретации
-                self.worksheet.append_rows(rows, value_input_option='RAW')
-                return True
-            
-            return False
-            
+            rows = [self._transaction_to_row(transaction) for transaction in transactions]
+            return self.append_rows(rows)
+
         except Exception as e:
             print(f"Ошибка при добавлении транзакций: {e}")
             return False
     
     def get_spreadsheet_url(self):
-        """Возвращает URL таблицы"""
-        if self.spreadsheet:
-            return self.spreadsheet.url
-        return None
+        """Возвращает URL таблицы (закеширован при подключении)"""
+        return self._url
 
@@ -1,10 +1,225 @@
 """
 Модуль для категоризации транзакций с помощью OpenAI
 """
-from openai import OpenAI
+from openai import OpenAI, RateLimitError
+import httpx
+import atexit
+import hashlib
 import json
+import logging
+import random
 import re
 import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+
+import config
+from rate_limiter import openai_bucket
+
+logger = logging.getLogger(__name__)
+
+# orjson (C-расширение) заметно быстрее stdlib на разборе ответов модели
+# и на сериализации (UTF-8 нативно, без ensure_ascii-экранирования);
+# при его отсутствии тихо откатываемся на stdlib json
+try:
+    import orjson
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj):
+        """Компактная сериализация в str (для SQLite-кеша)"""
+        return orjson.dumps(obj).decode()
+
+    def _json_dump_pretty(obj, f):
+        """Сериализация с отступами в бинарный файл (categories.json)"""
+        f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        """Компактная сериализация в str (для SQLite-кеша)"""
+        return json.dumps(obj, ensure_ascii=False)
+
+    def _json_dump_pretty(obj, f):
+        """Сериализация с отступами в бинарный файл (categories.json)"""
+        f.write(json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8'))
+
+__all__ = ['TransactionCategorizer', 'CacheMiss']
+
+
+class CacheMiss(Exception):
+    """Промах кеша в режиме CACHE_MODE=replay"""
+    pass
+
+
+# Нормализация текста для ключа кеша: "Кофе  30 " и "кофе 30" - одна запись
+_NORM_WS_RE = re.compile(r'\s+')
+
+# Паттерны горячих путей компилируем один раз при импорте, а не на каждый вызов
+_RE_NUMBER = re.compile(r'\d+(?:\.\d+)?')
+
+# Удаление одиночных символов валют - это str.translate по готовой
+# таблице, без regex-движка (числа остаются на regex: класс с повтором
+# в translate не выразить)
+_CUR_DEL_TABLE = str.maketrans('', '', '₪$€£₽')
+
+# Ключевые слова fallback-парсера с тегами: один скан строки одной
+# альтернацией вместо десятка независимых substring-проверок
+_FALLBACK_TAGS = {
+    'получил': 'income',
+    'зарплата': 'income',
+    'доход': 'income',
+    'заработал': 'income',
+    '+': 'income',
+    'income': 'income',
+    'salary': 'income',
+    'earned': 'income',
+    '$': 'USD',
+    'usd': 'USD',
+    'dollar': 'USD',
+    '€': 'EUR',
+    'eur': 'EUR',
+    'euro': 'EUR',
+    '₽': 'RUB',
+    'руб': 'RUB',
+    'rub': 'RUB',
+    '£': 'GBP',
+    'gbp': 'GBP',
+    'pound': 'GBP',
+}
+_FALLBACK_SCAN_RE = re.compile('|'.join(re.escape(kw) for kw in _FALLBACK_TAGS))
+
+# Размер in-memory LRU перед SQLite
+_MEM_CACHE_MAXSIZE = 4096
+
+# Жесткая схема ответа (Structured Outputs): сервер гарантирует ровно
+# эти поля без markdown-оберток и лишнего текста - меньше выходных
+# токенов и нет сбоев парсинга. category оставлена свободной строкой,
+# модель имеет право предлагать новые категории
+_TRANSACTION_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "Transaction",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "type": {"type": "string", "enum": ["Expense", "Income"]},
+                "amount": {"type": "number"},
+                "currency": {"type": "string", "enum": ["ILS", "USD", "EUR", "RUB", "GBP"]},
+                "category": {"type": "string"},
+                "description": {"type": "string"}
+            },
+            "required": ["type", "amount", "currency", "category", "description"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Курсы валют к ILS (примерные, можно обновлять). Один read-only словарь
+# на модуль вместо копии в каждом экземпляре; MappingProxyType защищает
+# от случайной мутации на горячем пути
+EXCHANGE_RATES = MappingProxyType({
+    'ILS': 1.0,
+    'USD': 3.7,
+    'EUR': 4.0,
+    'RUB': 0.04,
+    'GBP': 4.7
+})
+
+
+def _result_shape_ok(item):
+    """
+    Минимальная проверка типов ответа модели перед кешированием
+
+    json_object-режим (batch-путь) не гарантирует схему: null вместо
+    category или не-строка в currency переживут запись в кеш, а потом
+    будут ронять валидацию на каждом повторном хите этого текста.
+
+    Args:
+        item: элемент ответа модели
+
+    Returns:
+        bool: True если запись безопасно кешировать
+    """
+    if not isinstance(item, dict):
+        return False
+    # category обязана быть строкой: _validate_category зовет .lower()
+    if not isinstance(item.get('category'), str):
+        return False
+    # Остальные поля могут отсутствовать (валидация подставит дефолты),
+    # но присутствующие должны быть ожидаемого типа
+    for field in ('type', 'currency', 'description'):
+        if field in item and not isinstance(item[field], str):
+            return False
+    if 'amount' in item and not isinstance(item['amount'], (int, float, str)):
+        return False
+    return True
+
+
+def _normalize_text(text):
+    """Нормализует текст для ключа кеша (регистр + пробелы + хвостовая
+    пунктуация): "Кофе 30." и "кофе 30" - одна запись. Ведущий "+"
+    не трогаем - он несет смысл (доход)"""
+    return _NORM_WS_RE.sub(' ', text.strip().lower()).rstrip('.,!?;:')
+
+# Быстрый путь без OpenAI: тривиальные сообщения вида "кофе 200",
+# "200 кофе", "+5k freelance" разбираются локально за микросекунды
+_TRIVIAL_AMOUNT_FIRST = re.compile(
+    r'^\s*([+\-]?)\s*(\d+(?:[.,]\d+)?)\s*(k|к|тыс)?\s*(₽|руб|р|ils|nis|[$€£]|usd|eur|gbp)?\s+([\w\-]+)\s*$',
+    re.IGNORECASE
+)
+_TRIVIAL_WORD_FIRST = re.compile(
+    r'^\s*([\w\-]+)\s+([+\-]?)\s*(\d+(?:[.,]\d+)?)\s*(k|к|тыс)?\s*(₽|руб|р|ils|nis|[$€£]|usd|eur|gbp)?\s*$',
+    re.IGNORECASE
+)
+
+# Валютные маркеры быстрого пути (всё прочее в паттерне - ILS)
+_FAST_CURRENCIES = {
+    '₽': 'RUB',
+    'руб': 'RUB',
+    # Голое "р" ("такси 70р") ловится паттернами - без этой записи оно
+    # молча превращалось в ILS по курсу 1.0
+    'р': 'RUB',
+    '$': 'USD',
+    'usd': 'USD',
+    '€': 'EUR',
+    'eur': 'EUR',
+    '£': 'GBP',
+    'gbp': 'GBP',
+}
+
+# Однословные ключи, для которых категория известна без модели
+_FAST_CATEGORIES = {
+    'кофе': ('Expense', 'Restaurant', 'Coffee'),
+    'coffee': ('Expense', 'Restaurant', 'Coffee'),
+    'такси': ('Expense', 'Transport', 'Taxi'),
+    'taxi': ('Expense', 'Transport', 'Taxi'),
+    'метро': ('Expense', 'Transport', 'Metro'),
+    'автобус': ('Expense', 'Transport', 'Bus'),
+    'продукты': ('Expense', 'Grocery', 'Groceries'),
+    'groceries': ('Expense', 'Grocery', 'Groceries'),
+    'супермаркет': ('Expense', 'Grocery', 'Supermarket'),
+    'вино': ('Expense', 'Alcohol', 'Wine'),
+    'пиво': ('Expense', 'Alcohol', 'Beer'),
+    'цветы': ('Expense', 'Flower', 'Flowers'),
+    'аптека': ('Expense', 'Health', 'Pharmacy'),
+    'массаж': ('Expense', 'Health', 'Massage'),
+    'лекарства': ('Expense', 'Health', 'Medicine'),
+    'ресторан': ('Expense', 'Restaurant', 'Restaurant'),
+    'обед': ('Expense', 'Restaurant', 'Lunch'),
+    'ужин': ('Expense', 'Restaurant', 'Dinner'),
+    'бензин': ('Expense', 'Transport', 'Gas'),
+    'парковка': ('Expense', 'Transport', 'Parking'),
+    'книга': ('Expense', 'Books', 'Book'),
+    'зарплата': ('Income', 'Salary', 'Salary'),
+    'salary': ('Income', 'Salary', 'Salary'),
+    'фриланс': ('Income', 'Freelance', 'Freelance'),
+    'freelance': ('Income', 'Freelance', 'Freelance'),
+}
 
 
 class TransactionCategorizer:
@@ -16,11 +231,63 @@ class TransactionCategorizer:
             api_key: API ключ OpenAI
             trainer: экземпляр PromptTrainer (опционально)
         """
-        self.client = OpenAI(api_key=api_key)
+        # Общий httpx-клиент вместо дефолтного SDK: HTTP/2 мультиплексирует
+        # параллельные запросы по одному TCP-соединению, keep-alive убирает
+        # TLS-рукопожатие на каждый запрос при всплесках. Таймаут 30с вместо
+        # дефолтных 10 минут SDK: зависший запрос не должен держать
+        # поток-воркер дольше, чем пользователь готов ждать
+        self._http_client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=50,
+                keepalive_expiry=60,
+            ),
+            timeout=httpx.Timeout(30.0, connect=3.0),
+        )
+        self.client = OpenAI(api_key=api_key, http_client=self._http_client)
         self.trainer = trainer
-        
+
+        # Параметры модели (входят в ключ кеша). Задача - ~40 токенов
+        # структурированного JSON, mini-модель справляется с ней так же,
+        # но отвечает заметно быстрее и в разы дешевле
+        self.model = "gpt-4o-mini"
+        self.temperature = 0.1
+        self.max_tokens = 80
+
+        # Старшая модель для эскалации, когда mini возвращает битый JSON
+        self.fallback_model = "gpt-4o"
+
         # Файл для сохранения динамических категорий
         self.categories_file = 'categories.json'
+
+        # Персистентный кеш ответов: повторные тексты ("Coffee 200", "Taxi 1k")
+        # не должны заново ходить в OpenAI
+        self.cache_file = 'parse_cache.db'
+        self.cache_mode = config.CACHE_MODE
+        self._cache_conn = self._init_cache() if self.cache_mode != 'disabled' else None
+
+        # In-memory LRU поверх SQLite: частые повторы не трогают даже диск
+        self._mem_cache = OrderedDict()
+
+        # Счетчики попаданий быстрого пути (для настройки словаря)
+        self._fast_hits = 0
+        self._fast_misses = 0
+
+        # Кеши собранных system-промптов (см. _system_prompt и
+        # _batch_system_prompt)
+        self._prompt_cache = None
+        self._prompt_cache_key = None
+        self._batch_prompt_cache = None
+        self._batch_prompt_cache_key = None
+
+        # Склеенные CSV-списки категорий для промптов (см. _categories_csv)
+        self._categories_csv_cache = None
+        self._categories_csv_key = None
+
+        # Индекс категорий для O(1) проверки принадлежности
+        # (см. _validate_category)
+        self._category_index = {}
         
         # Предопределенные категории (based on user's GoldenSet)
         self.categories = {
@@ -58,26 +325,185 @@ class TransactionCategorizer:
         
         # Загружаем дополнительные категории из файла, если есть
         self._load_categories()
-        
-        # Курсы валют к ILS (примерные, можно обновлять)
-        self.exchange_rates = {
-            'ILS': 1.0,
-            'USD': 3.7,
-            'EUR': 4.0,
-            'RUB': 0.04,
-            'GBP': 4.7
-        }
+
+        # Дебаунс записи categories.json: новые категории часто приходят
+        # пачками (батч-загрузка), пишем на диск не чаще раза в 2 секунды
+        self._categories_dirty = False
+        self._save_timer = None
+        self._save_lock = threading.Lock()
+        atexit.register(self._flush_categories)
+
+        # Курсы валют - общий модульный словарь (см. EXCHANGE_RATES)
+        self.exchange_rates = EXCHANGE_RATES
     
+    def _init_cache(self):
+        """
+        Открывает SQLite-кеш распарсенных ответов
+
+        Returns:
+            sqlite3.Connection или None, если кеш недоступен
+        """
+        try:
+            conn = sqlite3.connect(self.cache_file, check_same_thread=False)
+            conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT)')
+            conn.commit()
+            return conn
+        except Exception as e:
+            print(f"[WARNING] Could not open parse cache: {e}")
+            return None
+
+    def _cache_key(self, text):
+        """Ключ кеша: blake2b от нормализованного текста + параметров модели
+
+        blake2b с 16-байтным дайджестом быстрее SHA256 и дает вдвое
+        короче ключи - их же мы храним в sqlite и в LRU.
+        """
+        normalized = _normalize_text(text)
+        return hashlib.blake2b(
+            f"{normalized}|{self.model}|{self.temperature}".encode(),
+            digest_size=16
+        ).hexdigest()
+
+    def _cache_get(self, key):
+        """Возвращает закешированный ответ модели или None"""
+        # Сначала in-memory LRU - без похода на диск
+        if key in self._mem_cache:
+            self._mem_cache.move_to_end(key)
+            return self._mem_cache[key]
+
+        if not self._cache_conn:
+            return None
+        try:
+            row = self._cache_conn.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+            if not row:
+                return None
+            result = _json_loads(row[0])
+            self._mem_cache_put(key, result)
+            return result
+        except Exception as e:
+            print(f"[WARNING] Cache read failed: {e}")
+            return None
+
+    def _mem_cache_put(self, key, result):
+        """Кладет запись в in-memory LRU с вытеснением старых"""
+        self._mem_cache[key] = result
+        self._mem_cache.move_to_end(key)
+        while len(self._mem_cache) > _MEM_CACHE_MAXSIZE:
+            self._mem_cache.popitem(last=False)
+
+    def _cache_evict(self, key):
+        """Удаляет битую запись из обоих уровней кеша"""
+        self._mem_cache.pop(key, None)
+        if not self._cache_conn:
+            return
+        try:
+            self._cache_conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+            self._cache_conn.commit()
+        except Exception as e:
+            print(f"[WARNING] Cache delete failed: {e}")
+
+    def _cache_put(self, key, result):
+        """Сохраняет ответ модели в кеш"""
+        self._mem_cache_put(key, result)
+
+        if not self._cache_conn:
+            return
+        try:
+            self._cache_conn.execute(
+                'INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)',
+                (key, _json_dumps(result))
+            )
+            self._cache_conn.commit()
+        except Exception as e:
+            print(f"[WARNING] Cache write failed: {e}")
+
+    def _try_fast_parse(self, text):
+        """
+        Пытается разобрать тривиальное сообщение без OpenAI
+
+        Срабатывает только когда сумма однозначно выделяется и
+        единственное слово есть в словаре известных категорий -
+        неоднозначные тексты уходят в модель как раньше.
+
+        Args:
+            text: текст сообщения
+
+        Returns:
+            dict с результатом или None, если текст не тривиальный
+        """
+        match = _TRIVIAL_AMOUNT_FIRST.match(text)
+        if match:
+            sign, amount_str, multiplier, currency_hint, word = match.groups()
+        else:
+            match = _TRIVIAL_WORD_FIRST.match(text)
+            if not match:
+                return None
+            word, sign, amount_str, multiplier, currency_hint = match.groups()
+
+        known = _FAST_CATEGORIES.get(word.lower())
+        if not known:
+            return None
+
+        transaction_type, category, description = known
+
+        amount = float(amount_str.replace(',', '.'))
+        if multiplier:
+            amount *= 1000
+
+        if sign == '+':
+            transaction_type = 'Income'
+
+        currency = 'ILS'
+        if currency_hint:
+            currency = _FAST_CURRENCIES.get(currency_hint.lower(), 'ILS')
+
+        self._fast_hits += 1
+        total = self._fast_hits + self._fast_misses
+        logger.debug("Fast-path hit for: %s (hit ratio %d/%d)", text, self._fast_hits, total)
+
+        return self._validate_result({
+            'type': transaction_type,
+            'amount': amount,
+            'currency': currency,
+            'category': category,
+            'description': description
+        }, text)
+
     def parse_transaction(self, text):
         """
         Парсит текст транзакции с помощью OpenAI
-        
+
         Args:
             text: текст сообщения от пользователя
-            
+
         Returns:
             dict с полями: type, amount, currency, category, description
         """
+        # Тривиальные тексты разбираем локально, без API вообще
+        fast = self._try_fast_parse(text)
+        if fast is not None:
+            return fast
+        self._fast_misses += 1
+
+        # Сначала смотрим в кеш - повторный текст не должен платить за API
+        cache_key = self._cache_key(text)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            logger.debug("Cache hit for: %s", text)
+            try:
+                # Копия, чтобы валидация не мутировала запись в кеше
+                return self._validate_result(dict(cached), text)
+            except Exception as e:
+                # Битая запись (например, старый кеш с null-полями) не
+                # должна ломать текст навсегда: выселяем и идем как при
+                # промахе
+                print(f"[WARNING] Evicting invalid cache entry for '{text}': {e}")
+                self._cache_evict(cache_key)
+
+        # В replay-режиме промах кеша - это ошибка, а не поход в API
+        if self.cache_mode == 'replay':
+            raise CacheMiss(f"No cached response for: {text}")
+
         try:
             # Получаем примеры из тренера, если есть
             training_examples = ""
@@ -100,11 +526,125 @@ class TransactionCategorizer:
 - "Цветы 60" -> {"type": "Expense", "amount": 60, "currency": "ILS", "category": "Flower", "description": "Flower"}
 - "+60302 зарплата и бонус" -> {"type": "Income", "amount": 60302, "currency": "ILS", "category": "Salary", "description": "Salary + Half a year bonus"}"""
             
-            # Формируем промпт для OpenAI
-            prompt = f"""
-You are a financial tracking assistant. Analyze the transaction message and extract information.
+            system_prompt = self._system_prompt(examples_section)
+            user_prompt = f'Message: "{text}"'
+
+            try:
+                result = self._request_and_decode(self.model, system_prompt, user_prompt)
+            except ValueError:
+                # mini-модель вернула битый JSON - одна попытка на старшей
+                # модели, прежде чем откатываться на локальный парсер
+                print(f"[WARNING] {self.model} returned invalid JSON, escalating to {self.fallback_model}")
+                result = self._request_and_decode(self.fallback_model, system_prompt, user_prompt)
+
+            # Кешируем сырой ответ модели; валидируем копию, чтобы
+            # _validate_result не мутировал запись, ушедшую в кеш
+            self._cache_put(cache_key, result)
+
+            return self._validate_result(dict(result), text)
+
+        except ValueError as e:
+            # Битый JSON даже после эскалации (json и orjson кидают ValueError)
+            print(f"Ошибка парсинга JSON: {e}")
+            return self._fallback_parse(text)
+
+        except Exception as e:
+            print(f"Ошибка при обработке транзакции: {e}")
+            return self._fallback_parse(text)
 
-Message: "{text}"
+    def _request_and_decode(self, model, system_prompt, user_prompt):
+        """
+        Выполняет один запрос к модели и декодирует JSON-ответ
+
+        Args:
+            model: имя модели
+            system_prompt: system-сообщение (стабильный префикс)
+            user_prompt: user-сообщение с текстом транзакции
+
+        Returns:
+            dict: сырой распарсенный ответ модели
+
+        Raises:
+            ValueError: если модель вернула некорректный JSON
+        """
+        # Ждем бюджет на запрос, чтобы не ловить 429 от OpenAI
+        openai_bucket.acquire((len(system_prompt) + len(user_prompt)) // 4 + self.max_tokens)
+
+        response = self._create_with_retry(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            response_format=_TRANSACTION_SCHEMA
+        )
+
+        # Извлекаем ответ; схема гарантирует чистый JSON без markdown
+        result_text = response.choices[0].message.content.strip()
+        logger.debug("GPT Raw Response: %s", result_text)
+
+        # Контроль попадания в prompt caching OpenAI: статичный
+        # system-префикс должен отдаваться из кеша (>=1024 токенов).
+        # Цепочку getattr раскручиваем только при включенном DEBUG
+        if logger.isEnabledFor(logging.DEBUG):
+            usage = getattr(response, 'usage', None)
+            details = getattr(usage, 'prompt_tokens_details', None) if usage else None
+            if details is not None:
+                logger.debug("Cached prompt tokens: %s", getattr(details, 'cached_tokens', 0))
+
+        # Парсим JSON
+        result = _json_loads(result_text)
+        logger.debug("Parsed result: %s", result)
+        return result
+
+    def _categories_csv(self):
+        """
+        Возвращает пару CSV-строк (Expense, Income) для подстановки в промпты
+
+        Склейка пересчитывается только при росте списков категорий, а не
+        на каждую пересборку одиночного и batch-промптов по отдельности.
+
+        Returns:
+            tuple: (expense_csv, income_csv)
+        """
+        key = (len(self.categories['Expense']), len(self.categories['Income']))
+        if key != self._categories_csv_key:
+            self._categories_csv_cache = (
+                ', '.join(self.categories['Expense']),
+                ', '.join(self.categories['Income']),
+            )
+            self._categories_csv_key = key
+        return self._categories_csv_cache
+
+    def _system_prompt(self, examples_section):
+        """
+        Возвращает system-промпт, пересобирая его только при изменениях
+
+        Склейка категорий и большой f-string на каждый вызов не нужны:
+        промпт меняется только когда добавилась категория или обновились
+        примеры тренера. Ключ кеша - примеры + длины списков категорий
+        (категории только добавляются). Стабильный префикс заодно лучше
+        попадает в prompt caching на стороне OpenAI.
+
+        Args:
+            examples_section: блок примеров для промпта
+
+        Returns:
+            str: готовый system-промпт
+        """
+        key = (examples_section, len(self.categories['Expense']), len(self.categories['Income']))
+        if key == self._prompt_cache_key:
+            return self._prompt_cache
+
+        expense_csv, income_csv = self._categories_csv()
+
+        # Инструкции, категории и примеры - в system-сообщение: этот
+        # префикс одинаков между вызовами, и OpenAI кеширует его
+        # (prompt caching), тарифицируя повторный префилл дешевле.
+        # В user-сообщении остается только сам текст транзакции
+        self._prompt_cache = f"""You are a financial tracking assistant. Analyze the transaction message and extract information.
 
 Return STRICTLY in JSON format with these fields:
 - type: "Expense" or "Income"
@@ -113,8 +653,8 @@ Return STRICTLY in JSON format with these fields:
 - category: pick ONE from the list below (or suggest a new one if nothing fits)
 - description: Brief English description (1-3 words, item/service only, NO amount, NO verbs)
 
-Expense categories: {', '.join(self.categories['Expense'])}
-Income categories: {', '.join(self.categories['Income'])}
+Expense categories: {expense_csv}
+Income categories: {income_csv}
 
 {examples_section}
 
@@ -124,72 +664,267 @@ RULES:
 - Description: translate to English, 1-3 words, essence only
 - IMPORTANT: If you create a new category, it will be automatically saved and available for future use
 
-Return ONLY JSON, no markdown, no extra text.
-"""
-            
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
+Return ONLY JSON, no markdown, no extra text."""
+        self._prompt_cache_key = key
+        return self._prompt_cache
+
+    def _validate_result(self, result, text):
+        """
+        Валидирует и нормализует результат парсинга от OpenAI
+
+        Args:
+            result: dict с ответом модели
+            text: исходный текст сообщения (для fallback описания)
+
+        Returns:
+            dict с гарантированными полями type, amount, currency, category,
+            description, amount_ils
+        """
+        # Валидация и нормализация категории
+        result = self._validate_category(result)
+
+        # Валидация результата
+        if 'type' not in result or result['type'] not in ['Expense', 'Income']:
+            result['type'] = 'Expense'
+
+        if 'amount' not in result:
+            result['amount'] = 0
+        else:
+            # Убеждаемся что amount - число
+            try:
+                result['amount'] = float(result['amount'])
+            except:
+                result['amount'] = 0
+
+        if 'currency' not in result:
+            result['currency'] = 'ILS'
+        else:
+            result['currency'] = result['currency'].upper()
+
+        if 'category' not in result:
+            result['category'] = 'Other'
+
+        if 'description' not in result:
+            result['description'] = text[:50]  # Первые 50 символов
+
+        # Добавляем конвертацию в ILS
+        result['amount_ils'] = self.convert_to_ils(result['amount'], result['currency'])
+
+        return result
+
+    def parse_transactions_batch(self, texts):
+        """
+        Парсит несколько транзакций одним запросом к OpenAI
+
+        Вместо N отдельных вызовов отправляем все тексты нумерованным
+        списком в одном промпте - один сетевой round-trip вместо N.
+
+        Args:
+            texts: список текстов сообщений от пользователя
+
+        Returns:
+            list[dict]: результаты в том же порядке, что и texts
+        """
+        if not texts:
+            return []
+
+        # Схлопываем повторы: каждый уникальный текст обрабатывается один раз,
+        # результат раздается всем его вхождениям. Дальше отделяем тексты
+        # с быстрым путем или кешем - в OpenAI идут только новые
+        unique_texts = dict.fromkeys(texts)
+
+        fast_results = {}
+        cached_results = {}
+        uncached_texts = []
+        for text in unique_texts:
+            fast = self._try_fast_parse(text)
+            if fast is not None:
+                fast_results[text] = fast
+                continue
+            self._fast_misses += 1
+            cache_key = self._cache_key(text)
+            cached = self._cache_get(cache_key)
+            if cached is not None and not _result_shape_ok(cached):
+                # Битая запись (старый кеш): выселяем и перезапрашиваем
+                print(f"[WARNING] Evicting invalid cache entry for '{text}'")
+                self._cache_evict(cache_key)
+                cached = None
+            if cached is not None:
+                cached_results[text] = cached
+            elif self.cache_mode == 'replay':
+                # В replay-режиме промах кеша - это ошибка, а не поход в API
+                raise CacheMiss(f"No cached response for: {text}")
+            else:
+                uncached_texts.append(text)
+
+        if uncached_texts:
+            fresh_results = self._parse_batch_uncached(uncached_texts)
+        else:
+            logger.debug("All %d texts served locally (fast path / cache)", len(texts))
+            fresh_results = {}
+
+        combined = dict(cached_results)
+        combined.update(fresh_results)
+
+        return [
+            fast_results[t] if t in fast_results else self._validate_result(dict(combined[t]), t)
+            for t in texts
+        ]
+
+    # Повторы при 429: экспоненциальная пауза с джиттером, чтобы
+    # параллельные воркеры не ломились в API синхронной волной
+    _MAX_API_RETRIES = 4
+
+    def _create_with_retry(self, **kwargs):
+        """
+        Вызывает chat.completions.create с повторами на rate limit
+
+        Локальный token bucket сглаживает поток заранее, но серверный
+        429 все равно возможен (общая квота аккаунта) - тогда ждем
+        min(60, 2^n) * (1 + random) секунд и пробуем снова.
+        """
+        for attempt in range(self._MAX_API_RETRIES):
+            try:
+                return self.client.chat.completions.create(**kwargs)
+            except RateLimitError:
+                if attempt == self._MAX_API_RETRIES - 1:
+                    raise
+                delay = min(60, 2 ** attempt) * (1 + random.random())
+                print(f"[WARNING] OpenAI rate limit, retry {attempt + 1} in {delay:.1f}s")
+                time.sleep(delay)
+
+    # Максимум текстов в одном marshaled-промпте: на длинных списках
+    # модель начинает терять и путать элементы, а выигрыш от амортизации
+    # round-trip выходит на плато в районе 8-16 входов
+    _MARSHAL_BATCH_SIZE = 16
+
+    def _batch_system_prompt(self, examples_section):
+        """
+        Возвращает system-промпт batch-пути (мемоизируется как одиночный)
+
+        Args:
+            examples_section: блок примеров для промпта
+
+        Returns:
+            str: готовый system-промпт
+        """
+        key = (examples_section, len(self.categories['Expense']), len(self.categories['Income']))
+        if key == self._batch_prompt_cache_key:
+            return self._batch_prompt_cache
+
+        expense_csv, income_csv = self._categories_csv()
+
+        self._batch_prompt_cache = f"""You are a financial tracking assistant. Analyze EACH numbered transaction message from the user and extract information.
+
+Return STRICTLY a JSON object with a single field "transactions" - an array with one element per message IN ORDER. Each element has these fields:
+- type: "Expense" or "Income"
+- amount: numeric value only (no currency symbol)
+- currency: ILS, USD, EUR, RUB, GBP (default: ILS)
+- category: pick ONE from the list below (or suggest a new one if nothing fits)
+- description: Brief English description (1-3 words, item/service only, NO amount, NO verbs)
+
+Expense categories: {expense_csv}
+Income categories: {income_csv}
+
+{examples_section}
+
+RULES:
+- Currency detection: руб/рублей->RUB, $->USD, €->EUR, ₪/шекель->ILS, default->ILS
+- Categories: TRY to use exact names from the list. If nothing fits well, feel free to suggest a NEW descriptive category name (use capital first letter, keep it short and clear, max 2-3 words)
+- Description: translate to English, 1-3 words, essence only
+
+Return ONLY JSON, no markdown, no extra text."""
+        self._batch_prompt_cache_key = key
+        return self._batch_prompt_cache
+
+    def _parse_batch_uncached(self, texts):
+        """
+        Выполняет batch-запрос к OpenAI для текстов, которых нет в кеше
+
+        Args:
+            texts: список уникальных текстов
+
+        Returns:
+            dict: {text: сырой ответ модели}
+        """
+        # Для одного текста batch-промпт не нужен
+        if len(texts) == 1:
+            text = texts[0]
+            result = self.parse_transaction(text)
+            return {text: result}
+
+        # Длинные списки режем на под-пачки по _MARSHAL_BATCH_SIZE
+        if len(texts) > self._MARSHAL_BATCH_SIZE:
+            results = {}
+            for start in range(0, len(texts), self._MARSHAL_BATCH_SIZE):
+                results.update(self._parse_batch_uncached(texts[start:start + self._MARSHAL_BATCH_SIZE]))
+            return results
+
+        try:
+            # Получаем примеры из тренера, если есть
+            training_examples = ""
+            if self.trainer:
+                training_examples = self.trainer.get_training_examples_for_prompt()
+
+            if training_examples:
+                examples_section = f"REAL EXAMPLES from your transaction history:\n{training_examples}"
+            else:
+                examples_section = ""
+
+            numbered_list = '\n'.join(f'{i}. "{text}"' for i, text in enumerate(texts, 1))
+
+            # Как и в одиночном пути: статичные инструкции - в system
+            # (byte-стабильный префикс для prompt caching), в user только
+            # переменная часть - список сообщений
+            system_prompt = self._batch_system_prompt(examples_section)
+            user_prompt = (
+                f"Messages ({len(texts)} items, return EXACTLY {len(texts)} elements):\n"
+                f"{numbered_list}"
+            )
+
+            # Ждем бюджет на запрос, чтобы не ловить 429 от OpenAI
+            openai_bucket.acquire((len(system_prompt) + len(user_prompt)) // 4 + 150 * len(texts))
+
+            response = self._create_with_retry(
+                model=self.model,
                 messages=[
-                    {"role": "system", "content": "You are a financial transaction analysis assistant. Respond only in JSON format."},
-                    {"role": "user", "content": prompt}
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
                 ],
-                temperature=0.1,
-                max_tokens=150
+                temperature=self.temperature,
+                max_tokens=150 * len(texts),
+                response_format={"type": "json_object"}
             )
-            
-            # Извлекаем ответ
+
             result_text = response.choices[0].message.content.strip()
-            print(f"[DEBUG] GPT Raw Response: {result_text}")
-            
-            # Убираем markdown форматирование если есть
-            result_text = re.sub(r'```json\s*', '', result_text)
-            result_text = re.sub(r'```\s*', '', result_text)
-            
-            # Парсим JSON
-            result = json.loads(result_text)
-            print(f"[DEBUG] Parsed result: {result}")
-            
-            # Валидация и нормализация категории
-            result = self._validate_category(result)
-            
-            # Валидация результата
-            if 'type' not in result or result['type'] not in ['Expense', 'Income']:
-                result['type'] = 'Expense'
-            
-            if 'amount' not in result:
-                result['amount'] = 0
-            else:
-                # Убеждаемся что amount - число
-                try:
-                    result['amount'] = float(result['amount'])
-                except:
-                    result['amount'] = 0
-            
-            if 'currency' not in result:
-                result['currency'] = 'ILS'
-            else:
-                result['currency'] = result['currency'].upper()
-            
-            if 'category' not in result:
-                result['category'] = 'Other'
-            
-            if 'description' not in result:
-                result['description'] = text[:50]  # Первые 50 символов
-            
-            # Добавляем конвертацию в ILS
-            result['amount_ils'] = self.convert_to_ils(result['amount'], result['currency'])
-            
-            return result
-            
-        except json.JSONDecodeError as e:
-            print(f"Ошибка парсинга JSON: {e}")
-            print(f"Ответ от OpenAI: {result_text}")
-            return self._fallback_parse(text)
-            
+            logger.debug("GPT Batch Raw Response: %s", result_text)
+
+            parsed_items = _json_loads(result_text).get('transactions', [])
+
+            if len(parsed_items) != len(texts):
+                print(f"[WARNING] Batch returned {len(parsed_items)} items for {len(texts)} texts, falling back to per-text parsing")
+                return {text: self.parse_transaction(text) for text in texts}
+
+            results = {}
+            for text, result in zip(texts, parsed_items):
+                # json_object-режим не гарантирует схему: null, строка
+                # или dict с полями не тех типов не должны попасть в кеш,
+                # иначе каждый повторный хит будет падать еще до
+                # fallback-ветки
+                if not _result_shape_ok(result):
+                    print(f"[WARNING] Malformed batch item for '{text}', reparsing individually")
+                    results[text] = self.parse_transaction(text)
+                    continue
+                self._cache_put(self._cache_key(text), result)
+                results[text] = result
+
+            return results
+
         except Exception as e:
-            print(f"Ошибка при обработке транзакции: {e}")
-            return self._fallback_parse(text)
-    
+            print(f"Ошибка при batch-обработке транзакций: {e}")
+            # Fallback: обрабатываем по одной
+            return {text: self.parse_transaction(text) for text in texts}
+
     def _fallback_parse(self, text):
         """
         Базовый парсинг без OpenAI (на случай ошибки)
@@ -197,27 +932,22 @@ Return ONLY JSON, no markdown, no extra text.
         print(f"[FALLBACK] Using fallback parser for: {text}")
         
         # Ищем числа в тексте
-        numbers = re.findall(r'\d+(?:\.\d+)?', text)
+        numbers = _RE_NUMBER.findall(text)
         amount = float(numbers[0]) if numbers else 0
         
-        # Определяем тип по ключевым словам
-        income_keywords = ['получил', 'зарплата', 'доход', 'заработал', '+', 'income', 'salary', 'earned']
-        transaction_type = 'Income' if any(keyword in text.lower() for keyword in income_keywords) else 'Expense'
-        
-        # Определяем валюту по символам
-        currency = 'ILS'
-        if '$' in text or 'usd' in text.lower() or 'dollar' in text.lower():
-            currency = 'USD'
-        elif '€' in text or 'eur' in text.lower() or 'euro' in text.lower():
-            currency = 'EUR'
-        elif '₽' in text or 'руб' in text.lower() or 'rub' in text.lower():
-            currency = 'RUB'
-        elif '£' in text or 'gbp' in text.lower() or 'pound' in text.lower():
-            currency = 'GBP'
+        # Один .lower() и один проход по строке: собираем теги всех
+        # найденных ключевых слов, дальше только ветвление по тегам
+        text_lower = text.lower()
+        tags = {_FALLBACK_TAGS[m.group(0)] for m in _FALLBACK_SCAN_RE.finditer(text_lower)}
+
+        transaction_type = 'Income' if 'income' in tags else 'Expense'
+
+        # Приоритет валют как в старой цепочке elif
+        currency = next((code for code in ('USD', 'EUR', 'RUB', 'GBP') if code in tags), 'ILS')
         
         # Убираем число из описания
-        description = re.sub(r'\d+(?:\.\d+)?', '', text).strip()
-        description = re.sub(r'[₪$€£₽]', '', description).strip()
+        description = _RE_NUMBER.sub('', text).strip()
+        description = description.translate(_CUR_DEL_TABLE).strip()
         # Первое слово как описание
         description = description.split()[0] if description else text[:20]
         
@@ -238,14 +968,15 @@ Return ONLY JSON, no markdown, no extra text.
         
         Args:
             amount: сумма
-            currency: валюта
-            
+            currency: валюта (код в верхнем регистре, как в EXCHANGE_RATES)
+
         Returns:
             сумма в шекелях
         """
-        currency = currency.upper()
-        rate = self.exchange_rates.get(currency, 1.0)
-        return round(amount * rate, 2)
+        # Ключи EXCHANGE_RATES уже в верхнем регистре, а все источники
+        # валюты (схема ответа, fast-path, fallback, _validate_result)
+        # нормализуют код один раз на границе - .upper() здесь не нужен
+        return round(amount * EXCHANGE_RATES.get(currency, 1.0), 2)
     
     def _load_categories(self):
         """
@@ -255,26 +986,63 @@ Return ONLY JSON, no markdown, no extra text.
             return
         
         try:
-            with open(self.categories_file, 'r', encoding='utf-8') as f:
-                additional_categories = json.load(f)
+            with open(self.categories_file, 'rb') as f:
+                additional_categories = _json_loads(f.read())
                 
-            # Добавляем категории к существующим (без дубликатов)
+            # Добавляем категории к существующим (без дубликатов);
+            # множество вместо `cat not in list` - иначе загрузка
+            # квадратична по мере роста списка
             for transaction_type in ['Expense', 'Income']:
                 if transaction_type in additional_categories:
+                    existing = set(self.categories[transaction_type])
                     for cat in additional_categories[transaction_type]:
-                        if cat not in self.categories[transaction_type]:
+                        if cat not in existing:
                             self.categories[transaction_type].append(cat)
+                            existing.add(cat)
                             print(f"[INFO] Loaded additional category: {transaction_type}/{cat}")
         except Exception as e:
             print(f"[WARNING] Could not load categories from file: {e}")
     
     def _save_categories(self):
         """
-        Сохраняет текущие категории в файл
+        Планирует сохранение категорий в файл (дебаунс 2 секунды)
+
+        Сама запись происходит в _flush_categories: либо по таймеру,
+        либо при завершении процесса (atexit).
+        """
+        with self._save_lock:
+            self._categories_dirty = True
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(2.0, self._flush_categories)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def _flush_categories(self):
         """
+        Пишет категории на диск, если были изменения
+
+        Запись атомарная: сначала во временный файл рядом, затем
+        os.replace - читатель никогда не увидит полузаписанный JSON.
+        """
+        with self._save_lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if not self._categories_dirty:
+                return
+            self._categories_dirty = False
         try:
-            with open(self.categories_file, 'w', encoding='utf-8') as f:
-                json.dump(self.categories, f, indent=2, ensure_ascii=False)
+            target_dir = os.path.dirname(self.categories_file) or '.'
+            fd, tmp_path = tempfile.mkstemp(
+                dir=target_dir, prefix='.categories-', suffix='.tmp'
+            )
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    _json_dump_pretty(self.categories, f)
+                os.replace(tmp_path, self.categories_file)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
             print(f"[INFO] Categories saved to {self.categories_file}")
         except Exception as e:
             print(f"[WARNING] Could not save categories to file: {e}")
@@ -291,20 +1059,43 @@ Return ONLY JSON, no markdown, no extra text.
         
         category = result['category']
         transaction_type = result.get('type', 'Expense')
-        
-        # Проверяем, есть ли категория в списке
+
+        # Проверяем, есть ли категория в списке: set вместо линейного
+        # поиска по списку на каждый распарсенный ответ. Индекс
+        # перестраивается при росте списка (категории только добавляются)
         valid_categories = self.categories.get(transaction_type, [])
-        
-        if category in valid_categories:
+        cached = self._category_index.get(transaction_type)
+        if cached is None or cached[0] != len(valid_categories):
+            cached = (
+                len(valid_categories),
+                frozenset(valid_categories),
+                {cat.lower(): cat for cat in valid_categories}
+            )
+            self._category_index[transaction_type] = cached
+        _, valid_set, lower_map = cached
+
+        if category in valid_set:
             return result
-        
+
+        # Регистронезависимое точное совпадение - O(1) вместо прохода
+        # по всем парам в цикле похожести
+        exact = lower_map.get(category.lower())
+        if exact is not None:
+            result['category'] = exact
+            return result
+
         # Категории нет в списке - пытаемся найти похожую
         print(f"[WARNING] Category '{category}' not in the list. Trying to match...")
         
-        # Поиск похожей категории (простой алгоритм)
+        # Поиск похожей категории (простой алгоритм): идем по lowercase-
+        # индексу, чтобы не лоуэркейсить кандидата на каждой паре заново
+        category_lower = category.lower()
+        check_prefix = len(category_lower) > 3
         matched = False
-        for valid_cat in valid_categories:
-            if self._category_similar(category, valid_cat):
+        for valid_lower, valid_cat in lower_map.items():
+            if (category_lower in valid_lower or valid_lower in category_lower
+                    or (check_prefix and len(valid_lower) > 3
+                        and category_lower[:4] == valid_lower[:4])):
                 print(f"[INFO] Matched '{category}' -> '{valid_cat}'")
                 result['category'] = valid_cat
                 matched = True
@@ -321,29 +1112,20 @@ Return ONLY JSON, no markdown, no extra text.
             
             # Сохраняем обновлённые категории в файл
             self._save_categories()
-        
+
         return result
-    
-    def _category_similar(self, cat1, cat2):
+
+    def close(self):
         """
-        Проверяет, похожи ли две категории
+        Закрывает сетевые и дисковые ресурсы категоризатора
         """
-        cat1_lower = cat1.lower()
-        cat2_lower = cat2.lower()
-        
-        # Точное совпадение
-        if cat1_lower == cat2_lower:
-            return True
-        
-        # Одна содержит другую
-        if cat1_lower in cat2_lower or cat2_lower in cat1_lower:
-            return True
-        
-        # Проверка на опечатки (простой способ)
-        if len(cat1) > 3 and len(cat2) > 3:
-            # Если первые 4 буквы совпадают
-            if cat1_lower[:4] == cat2_lower[:4]:
-                return True
-        
-        return False
-
+        self._flush_categories()
+        try:
+            self._http_client.close()
+        except Exception as e:
+            print(f"[WARNING] Could not close HTTP client: {e}")
+        if self._cache_conn is not None:
+            try:
+                self._cache_conn.close()
+            except Exception as e:
+                print(f"[WARNING] Could not close parse cache: {e}")
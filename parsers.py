@@ -0,0 +1,60 @@
+"""
+Общие парсеры текста транзакций
+"""
+from functools import lru_cache
+
+# Слово-маркер подписки; работаем чистыми str-методами без regex-движка
+_SUBSCRIPTION_NEEDLE = 'подписка'
+
+
+# Функция чистая, а пользователи часто повторяют одни и те же фразы
+# ("кофе 30", "такси 50") - на повторе хватает одного dict-лукапа
+@lru_cache(maxsize=1024)
+def parse_subscription(text):
+    """
+    Парсит информацию о подписке из текста
+
+    Args:
+        text: текст транзакции
+
+    Returns:
+        str: "Yes" если подписка без номера, номер если есть, "" если не подписка
+
+    Логика: ищет цифру сразу после слова "подписка" (с пробелом или без).
+    Если находит - это номер платежа. Если не находит - это простая подписка (Yes).
+    """
+    # В подавляющем большинстве сообщений подписки нет - проверяем
+    # без аллокации .lower(): на практике слово пишут строчными или
+    # с заглавной буквы
+    if ('подписка' not in text and 'Подписка' not in text
+            and 'ПОДПИСКА' not in text):
+        return ''
+
+    text_lower = text.lower()
+
+    # Ручной скан вместо regex: ищем однозначную цифру (1-9) сразу после
+    # "подписка" - либо вплотную ("подписка3"), либо через пробелы с
+    # границей слова ("подписка 3", но не "подписка 30" - это сумма)
+    length = len(text_lower)
+    idx = text_lower.find(_SUBSCRIPTION_NEEDLE)
+
+    while idx >= 0:
+        j = idx + len(_SUBSCRIPTION_NEEDLE)
+
+        # Цифра вплотную: "подписка3"
+        if j < length and text_lower[j] in '123456789':
+            return text_lower[j]
+
+        # Цифра через пробелы: "подписка 3" (однозначная, дальше не цифра/буква)
+        k = j
+        while k < length and text_lower[k].isspace():
+            k += 1
+        if k > j and k < length and text_lower[k] in '123456789':
+            after = k + 1
+            if after >= length or not (text_lower[after].isalnum() or text_lower[after] == '_'):
+                return text_lower[k]
+
+        idx = text_lower.find(_SUBSCRIPTION_NEEDLE, idx + 1)
+
+    # Номер не нашли - это простая подписка
+    return 'Yes'
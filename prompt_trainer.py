@@ -1,13 +1,81 @@
 """
 Модуль для обучения промпта категоризации на основе реальных данных
 """
+import heapq
 import logging
+import re
+import time
+from collections import namedtuple
+from itertools import zip_longest
 from google_sheets import GoogleSheetsManager
 from datetime import datetime, timedelta
 import config
 
 logger = logging.getLogger(__name__)
 
+# Колонки листа, реально используемые при обучении (раскладка - см.
+# _ensure_headers в google_sheets.py): B=Type, C=Description, D=Category,
+# E=Amount, F=Currency, I=input, K=Corrected
+_TRAINING_COLUMNS = ('B', 'C', 'D', 'E', 'F', 'I', 'K')
+_TrainingRow = namedtuple(
+    '_TrainingRow',
+    ['type', 'description', 'category', 'amount', 'currency', 'input', 'corrected']
+)
+
+# Значения колонки Corrected, считающиеся отметкой "исправлено"
+_TRUE_MARKS = frozenset(('yes', 'true', '1', '✓', 'v'))
+
+
+class TrainingExample:
+    """
+    Обучающий пример для промпта
+
+    Слотированный класс вместо dict с 7 ключами: в несколько раз
+    компактнее в памяти, а чтение полей - прямой attribute load
+    вместо hash-лукапа с .get. Обычный класс с __slots__, а не
+    dataclass(slots=True): параметр slots появился только в 3.10,
+    а runtime.txt закрепляет 3.9
+    """
+    __slots__ = ('input', 'type', 'category', 'description', 'amount',
+                 'currency', 'corrected', 'tx_type', 'is_corrected')
+
+    def __init__(self, input, type, category, description, amount,
+                 currency='ILS', corrected='', tx_type='', is_corrected=False):
+        self.input = input
+        self.type = type
+        self.category = category
+        self.description = description
+        self.amount = amount
+        self.currency = currency
+        self.corrected = corrected
+        self.tx_type = tx_type
+        # Флаг "исправлено" канонизируется один раз при загрузке: скоринг
+        # примеров читает готовый bool вместо .lower() + поиска по меткам
+        self.is_corrected = is_corrected
+
+# Шаблон строки-примера для промпта; bound .format вместо f-string
+# в цикле - подстановка без пересборки литерала на каждой итерации
+_EXAMPLE_FMT = '- "{}" -> {{"type": "{}", "category": "{}", "description": "{}"}}'.format
+
+# Нормализация input для дедупликации примеров: "кофе 15" и "кофе 16"
+# несут одинаковую информацию для промпта
+_NORM_NUM_RE = re.compile(r'\d+')
+
+
+def _next_monday_3am(after):
+    """
+    Возвращает ближайший понедельник 03:00 строго после заданного момента
+
+    Args:
+        after: datetime, от которого отсчитывать
+
+    Returns:
+        datetime: момент следующего переобучения
+    """
+    days_ahead = (7 - after.weekday()) % 7 or 7
+    next_monday = after + timedelta(days=days_ahead)
+    return next_monday.replace(hour=3, minute=0, second=0, microsecond=0)
+
 
 class PromptTrainer:
     def __init__(self, categorizer, sheets_manager):
@@ -22,7 +90,104 @@ class PromptTrainer:
         self.sheets_manager = sheets_manager
         self.last_training_date = None
         self.training_data_cache = []
+
+        # TTL-кеш сырых записей из Sheets: поход в API - доминирующая
+        # задержка при построении промпта, а данные меняются редко
+        self._records_cache = None
+        self._records_cache_ts = 0.0
+        self._records_ttl = getattr(config, 'TRAINING_CACHE_TTL', 600)
+
+        # Мемоизация готового текста примеров: строится на каждый запрос
+        # к GPT, а данные меняются от силы раз в TTL
+        self._prompt_text_cache = None
+        self._prompt_text_key = None
+
+        # Drive modifiedTime таблицы на момент последней загрузки:
+        # дешевый признак "данные не менялись" для пропуска полной
+        # перезагрузки (меняется при любой правке, включая appends
+        # внутри сетки и клетки Corrected)
+        self._last_modified_time = None
+
+        # Дедлайн следующего переобучения: считается один раз после
+        # успешного обучения, should_retrain сводится к сравнению
+        self._next_retrain_at = None
     
+    def _fetch_training_rows(self, limit=None):
+        """
+        Забирает обучающие колонки values.batchGet-запросом
+
+        get_all_records() тянет весь лист и строит dict на каждую строку;
+        здесь запрашиваются только 7 нужных колонок, а строки склеиваются
+        в легкие namedtuple. При заданном limit читается только хвостовое
+        окно листа (2*limit строк): примеров нужно десятки, а лист со
+        временем растет до тысяч строк.
+
+        Args:
+            limit: сколько примеров нужно вызывающему (None - весь лист)
+
+        Returns:
+            list[_TrainingRow]: строки листа без заголовка
+        """
+        worksheet = self.sheets_manager.worksheet
+        start_row = 2
+        if limit:
+            start_row = max(2, worksheet.row_count - 2 * limit + 1)
+
+        rows = self._batch_get_rows(start_row)
+
+        # row_count - размер сетки, а не данных: у листа может быть
+        # пустой хвост, и окно окажется неполным. Тогда читаем целиком
+        if start_row > 2 and sum(1 for r in rows if r.input and r.category) < limit:
+            rows = self._batch_get_rows(2)
+
+        return rows
+
+    def _batch_get_rows(self, start_row):
+        """
+        Читает колонки _TRAINING_COLUMNS начиная со строки start_row
+
+        Args:
+            start_row: первая строка диапазона (2 - сразу после заголовка)
+
+        Returns:
+            list[_TrainingRow]: склеенные строки
+        """
+        worksheet = self.sheets_manager.worksheet
+        ranges = [
+            f"'{worksheet.title}'!{col}{start_row}:{col}"
+            for col in _TRAINING_COLUMNS
+        ]
+        response = self.sheets_manager.spreadsheet.values_batch_get(
+            ranges, params={'majorDimension': 'COLUMNS'}
+        )
+
+        columns = []
+        for value_range in response.get('valueRanges', []):
+            values = value_range.get('values') or [[]]
+            columns.append(values[0])
+
+        # Колонки могут отличаться длиной: API обрезает хвостовые пустые
+        # ячейки, поэтому выравниваем через zip_longest
+        return [_TrainingRow(*row) for row in zip_longest(*columns, fillvalue='')]
+
+    def _sheet_modified_time(self):
+        """
+        Возвращает Drive modifiedTime таблицы одним metadata-запросом
+
+        Запрос отдает только метаданные файла без значений - на порядки
+        дешевле values-чтения. В отличие от rowCount сетки (который не
+        двигается ни от appends внутри преаллоцированной сетки, ни от
+        правок Corrected), modifiedTime меняется при любой записи.
+
+        Returns:
+            str (ISO-таймстамп) или None, если метаданные недоступны
+        """
+        try:
+            return self.sheets_manager.spreadsheet.get_lastUpdateTime()
+        except Exception as e:
+            logger.warning("Could not fetch spreadsheet metadata: %s", e)
+            return None
+
     def load_training_data(self, limit=50):
         """
         Загружает примеры из Google Sheets для обучения
@@ -31,41 +196,76 @@ class PromptTrainer:
             limit: максимум примеров для загрузки (по умолчанию 50)
             
         Returns:
-            list: список примеров [{"input": "...", "category": "...", "description": "..."}, ...]
+            list[TrainingExample]: список примеров
         """
         if not self.sheets_manager or not self.sheets_manager.worksheet:
             logger.error("Sheets manager not connected")
             return []
         
         try:
-            # Получаем все данные из таблицы
-            all_values = self.sheets_manager.worksheet.get_all_records()
-            
-            training_data = []
-            for row in all_values:
+            # Получаем данные из таблицы; пока TTL-кеш свеж - из памяти,
+            # без похода в Sheets API
+            now = time.monotonic()
+            if (self._records_cache is not None
+                    and now - self._records_cache_ts < self._records_ttl):
+                all_rows = self._records_cache
+            else:
+                # Перед полной перезагрузкой сверяем Drive modifiedTime:
+                # если таблицу не трогали с прошлой загрузки - продлеваем
+                # кеш ценой одного metadata-запроса вместо values-чтения.
+                # None (метаданные недоступны) трактуем как "изменилось"
+                modified_time = self._sheet_modified_time()
+                if (self._records_cache is not None and modified_time is not None
+                        and modified_time == self._last_modified_time):
+                    self._records_cache_ts = now
+                    all_rows = self._records_cache
+                else:
+                    all_rows = self._fetch_training_rows(limit)
+                    self._records_cache = all_rows
+                    self._records_cache_ts = now
+                    self._last_modified_time = modified_time
+
+            # Почти одинаковые строки ("кофе 15" / "кофе 16") схлопываем
+            # еще при загрузке: ключ - input с цифрами, замененными на #,
+            # плюс категория; поздние строки перезаписывают ранние
+            deduped = {}
+            for row in all_rows:
                 # Пропускаем пустые строки
-                if not row.get('input'):
+                if not row.input:
                     continue
-                
-                training_example = {
-                    'input': row.get('input', ''),
-                    'type': row.get('Type', ''),
-                    'category': row.get('Category', ''),
-                    'description': row.get('Description', ''),
-                    'amount': row.get('Amount', ''),
-                    'currency': row.get('Currency', 'ILS'),
-                    'corrected': row.get('Corrected', '')
-                }
-                
+
+                # Тип транзакции для примера промпта определяем один раз
+                # при загрузке, а не на каждую пересборку промпта
+                inp_lower = row.input.lower()
+                tx_type = ('Income'
+                           if '+' in row.input or 'salary' in inp_lower
+                           or 'доход' in inp_lower
+                           else 'Expense')
+
                 # Добавляем только если есть все необходимые поля
-                if training_example['input'] and training_example['category']:
-                    training_data.append(training_example)
-                    
-                    if len(training_data) >= limit:
-                        break
-            
+                if row.input and row.category:
+                    key = (_NORM_NUM_RE.sub('#', inp_lower).strip(), row.category)
+                    deduped[key] = TrainingExample(
+                        input=row.input,
+                        type=row.type,
+                        category=row.category,
+                        description=row.description,
+                        amount=row.amount,
+                        currency=row.currency or 'ILS',
+                        corrected=row.corrected,
+                        tx_type=tx_type,
+                        is_corrected=row.corrected.strip().lower() in _TRUE_MARKS
+                    )
+
+            # Лимит применяем к хвосту: свежие примеры полезнее старых
+            training_data = list(deduped.values())
+            if len(training_data) > limit:
+                training_data = training_data[-limit:]
+
             logger.info(f"Loaded {len(training_data)} training examples")
             self.training_data_cache = training_data
+            # Свежая загрузка - текст примеров нужно пересобрать
+            self._prompt_text_key = None
             return training_data
             
         except Exception as e:
@@ -77,8 +277,8 @@ class PromptTrainer:
         Формирует текст с примерами для промпта
         
         Args:
-            training_data: список примеров (если None - использует кеш)
-            
+            training_data: список TrainingExample (если None - использует кеш)
+
         Returns:
             str: форматированная строка с примерами
         """
@@ -89,40 +289,56 @@ class PromptTrainer:
             return ""
         
         examples = []
-        
-        # Разделяем на исправленные и обычные
-        corrected_examples = [ex for ex in training_data if ex.get('corrected', '').lower() in ['yes', 'true', '1', '✓', 'v']]
-        regular_examples = [ex for ex in training_data if ex.get('corrected', '').lower() not in ['yes', 'true', '1', '✓', 'v']]
-        
-        # Приоритет: сначала исправленные, потом обычные
-        # Берем последние исправленные + остальное из обычных до 15
-        selected_examples = []
-        
-        # Добавляем последние исправленные (максимум 10)
-        selected_examples.extend(corrected_examples[-10:])
-        
-        # Добавляем обычные до общего лимита 15
-        remaining_slots = 15 - len(selected_examples)
-        if remaining_slots > 0:
-            selected_examples.extend(regular_examples[-remaining_slots:])
-        
-        # Берем последние 15 из выбранных
-        final_examples = selected_examples[-15:] if len(selected_examples) > 15 else selected_examples
-        
-        for i, example in enumerate(final_examples, 1):
-            input_text = example['input']
-            category = example['category']
-            description = example.get('description', input_text.split()[0])
-            amount = example.get('amount', '')
-            
-            # Форматируем пример
-            if '+' in input_text or 'salary' in input_text.lower() or 'доход' in input_text.lower():
-                transaction_type = 'Income'
-            else:
-                transaction_type = 'Expense'
-            
-            example_text = f'- "{input_text}" -> {{"type": "{transaction_type}", "category": "{category}", "description": "{description}"}}'
-            examples.append(example_text)
+
+        # Отбираем K самых информативных примеров вместо простого хвоста:
+        # каждый пример - токены в каждом запросе к OpenAI. Исправленные
+        # пользователем весят больше всего (+3), первый пример новой
+        # категории полезнее очередного повтора (+1), свежие строки
+        # получают дробный бонус. Почти одинаковые input ("кофе 15" /
+        # "кофе 16") схлопываются до самого свежего
+        top_k = getattr(config, 'TRAINING_EXAMPLES_LIMIT', 8)
+        total = len(training_data)
+
+        seen_inputs = set()
+        seen_categories = set()
+        scored = []
+        # Идем от свежих к старым: новизна категории и дедупликация
+        # должны доставаться самым свежим примерам
+        for age, ex in enumerate(reversed(training_data)):
+            normalized = _NORM_NUM_RE.sub('#', ex.input.lower()).strip()
+            if normalized in seen_inputs:
+                continue
+            seen_inputs.add(normalized)
+
+            score = 0.0
+            if ex.is_corrected:
+                score += 3.0
+            category = ex.category
+            if category not in seen_categories:
+                seen_categories.add(category)
+                score += 1.0
+            score += (total - age) / total  # бонус свежести, (0, 1]
+
+            scored.append((score, -age, ex))
+
+        # -age вторым элементом: хронологический порядок в промпте
+        final_examples = [item[2] for item in sorted(heapq.nlargest(top_k, scored), key=lambda item: item[1])]
+
+        for example in final_examples:
+            input_text = example.input
+            description = example.description or input_text.split()[0]
+
+            # Тип уже вычислен при загрузке; пересчет по подстрокам -
+            # только для примеров, собранных мимо load_training_data
+            transaction_type = example.tx_type
+            if not transaction_type:
+                input_lower = input_text.lower()
+                transaction_type = ('Income'
+                                    if '+' in input_text or 'salary' in input_lower
+                                    or 'доход' in input_lower
+                                    else 'Expense')
+
+            examples.append(_EXAMPLE_FMT(input_text, transaction_type, example.category, description))
         
         return '\n'.join(examples)
     
@@ -131,6 +347,11 @@ class PromptTrainer:
         Обновляет промпт категоризатора с новыми примерами
         """
         try:
+            # Переобучение не должно жить на TTL-кеше: гасим TTL, а
+            # дальше проверка Drive modifiedTime решит, нужна ли полная
+            # перезагрузка
+            self._records_cache_ts = 0.0
+
             # Загружаем данные
             training_data = self.load_training_data()
             
@@ -138,9 +359,10 @@ class PromptTrainer:
                 logger.warning("No training data available")
                 return False
             
-            # Сохраняем дату обучения
+            # Сохраняем дату обучения и сразу считаем следующий дедлайн
             self.last_training_date = datetime.now()
-            
+            self._next_retrain_at = _next_monday_3am(self.last_training_date)
+
             logger.info(f"Prompt trainer updated with {len(training_data)} examples")
             return True
             
@@ -151,34 +373,36 @@ class PromptTrainer:
     def should_retrain(self):
         """
         Проверяет, нужно ли переобучать (каждый понедельник)
-        
+
+        Дедлайн вычислен заранее в update_categorizer_prompt, поэтому
+        проверка - одно сравнение datetime (вызывается и из get_stats,
+        и из еженедельной задачи).
+
         Returns:
             bool: True если нужно переобучить
         """
-        if self.last_training_date is None:
-            return True
-        
-        now = datetime.now()
-        
-        # Проверяем, был ли уже понедельник после последнего обучения
-        days_since_training = (now - self.last_training_date).days
-        is_monday = now.weekday() == 0  # 0 = Monday
-        
-        # Переобучаем каждый понедельник
-        if is_monday and days_since_training >= 7:
-            return True
-        
-        return False
+        return self._next_retrain_at is None or datetime.now() >= self._next_retrain_at
     
     def get_training_examples_for_prompt(self):
         """
         Возвращает примеры для добавления в промпт GPT
         Используется в openai_categorizer.py
+
+        Текст мемоизируется по дешевому отпечатку кеша данных (длина +
+        input последней строки): пересборка выполняется только после
+        новой загрузки, а не на каждый вызов GPT.
         """
         if not self.training_data_cache:
             self.load_training_data()
-        
-        return self.build_training_examples_text()
+
+        cache = self.training_data_cache
+        key = (len(cache), cache[-1].input if cache else '')
+        if key == self._prompt_text_key:
+            return self._prompt_text_cache
+
+        self._prompt_text_cache = self.build_training_examples_text()
+        self._prompt_text_key = key
+        return self._prompt_text_cache
     
     def get_stats(self):
         """
@@ -196,19 +420,29 @@ class PromptTrainer:
 
 def schedule_weekly_training(app, trainer):
     """
-    Запускает еженедельное обучение по понедельникам
+    Планирует еженедельное обучение по понедельникам через JobQueue
+
+    Одно событие в неделю вместо периодического опроса should_retrain:
+    JobQueue сам будит задачу в нужный момент.
     """
     import asyncio
+    import datetime
     from telegram.ext import CallbackContext
-    
+
     async def train_task(context: CallbackContext):
         if trainer.should_retrain():
             logger.info("Starting weekly training...")
-            success = trainer.update_categorizer_prompt()
+            # Поход в Sheets - блокирующий I/O, уводим из event loop
+            success = await asyncio.to_thread(trainer.update_categorizer_prompt)
             if success:
                 logger.info("Weekly training completed successfully")
             else:
                 logger.warning("Weekly training failed")
-    
-    # Проверяем каждые 6 часов
-    return asyncio.create_task(train_task(None))
+
+    # Понедельник, 03:00 - когда бот наверняка простаивает
+    return app.job_queue.run_daily(
+        train_task,
+        time=datetime.time(hour=3),
+        days=(0,),  # 0 = Monday
+        name='weekly_prompt_train'
+    )
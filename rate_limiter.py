@@ -0,0 +1,96 @@
+"""
+Клиентский rate limiting для внешних API (OpenAI, Google Sheets)
+"""
+import time
+import threading
+
+
+class TokenBucket:
+    """
+    Token bucket для ограничения частоты исходящих запросов
+
+    Держит два бюджета: на запросы в минуту и (опционально) на токены
+    в минуту, как у OpenAI (RPM/TPM). Бюджеты пополняются непрерывно
+    пропорционально прошедшему времени. acquire() блокирует до тех пор,
+    пока на запрос не хватит обоих бюджетов - так мы сами сглаживаем
+    нагрузку чуть ниже квоты вместо того, чтобы ловить 429 от сервера.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute=None):
+        """
+        Args:
+            requests_per_minute: лимит запросов в минуту
+            tokens_per_minute: лимит токенов в минуту (None - не учитывать)
+        """
+        self.request_rate = requests_per_minute / 60.0
+        self.request_capacity = float(requests_per_minute)
+        self.request_tokens = float(requests_per_minute)
+
+        if tokens_per_minute is not None:
+            self.token_rate = tokens_per_minute / 60.0
+            self.token_capacity = float(tokens_per_minute)
+            self.token_tokens = float(tokens_per_minute)
+        else:
+            self.token_rate = None
+            self.token_capacity = None
+            self.token_tokens = None
+
+        self.last_update = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        """Пополняет бюджеты пропорционально прошедшему времени"""
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+
+        self.request_tokens = min(
+            self.request_capacity,
+            self.request_tokens + elapsed * self.request_rate
+        )
+
+        if self.token_rate is not None:
+            self.token_tokens = min(
+                self.token_capacity,
+                self.token_tokens + elapsed * self.token_rate
+            )
+
+    def acquire(self, estimated_tokens=0):
+        """
+        Блокирует, пока не наберется бюджет на один запрос
+
+        Args:
+            estimated_tokens: оценка токенов запроса (для TPM-бюджета)
+        """
+        while True:
+            with self._lock:
+                self._refill()
+
+                have_request = self.request_tokens >= 1.0
+                have_tokens = (
+                    self.token_rate is None
+                    or self.token_tokens >= estimated_tokens
+                )
+
+                if have_request and have_tokens:
+                    self.request_tokens -= 1.0
+                    if self.token_rate is not None:
+                        self.token_tokens -= estimated_tokens
+                    return
+
+                # Считаем, сколько ждать до пополнения недостающего бюджета
+                wait = 0.0
+                if not have_request:
+                    wait = (1.0 - self.request_tokens) / self.request_rate
+                if not have_tokens:
+                    wait = max(
+                        wait,
+                        (estimated_tokens - self.token_tokens) / self.token_rate
+                    )
+
+            time.sleep(min(wait, 1.0))
+
+
+# Общие лимитеры: OpenAI (60 RPM / 90k TPM), Sheets (300 записей/мин)
+openai_bucket = TokenBucket(60, tokens_per_minute=90000)
+sheets_bucket = TokenBucket(300)
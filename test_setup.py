@@ -1,5 +1,9 @@
 """
 Скрипт для тестирования настройки бота
+
+Тяжелые импорты (SDK OpenAI, gspread) - внутри конкретных проверок:
+диагностика не должна платить за них на холодном старте, особенно
+когда падает уже проверка окружения.
 """
 import sys
 import os
@@ -85,6 +89,25 @@ def test_openai():
         return False
 
 
+async def _run_network_tests():
+    """
+    Запускает сетевые проверки параллельно
+
+    Проверки Google Sheets и OpenAI - это независимые round-trip'ы,
+    последовательно они складываются, параллельно - занимают время
+    самой медленной.
+
+    Returns:
+        tuple: (sheets_ok, openai_ok)
+    """
+    import asyncio
+
+    return await asyncio.gather(
+        asyncio.to_thread(test_google_sheets),
+        asyncio.to_thread(test_openai),
+    )
+
+
 def main():
     """Основная функция тестирования"""
     print("=" * 50)
@@ -101,11 +124,9 @@ def main():
         print("\n💡 Создайте файл .env на основе env_example.txt")
         sys.exit(1)
     
-    # Проверка Google Sheets
-    sheets_ok = test_google_sheets()
-    
-    # Проверка OpenAI
-    openai_ok = test_openai()
+    # Проверка Google Sheets и OpenAI - параллельно
+    import asyncio
+    sheets_ok, openai_ok = asyncio.run(_run_network_tests())
     
     # Итоги
     print("\n" + "=" * 50)
@@ -115,6 +136,8 @@ def main():
     else:
         print("❌ Некоторые тесты не прошли.")
         print("⚠️  Проверьте настройки и попробуйте снова.")
+        print("=" * 50)
+        sys.exit(2)
     print("=" * 50)
 
 